@@ -51,14 +51,12 @@ def get_user_path(email):
     path.append(email)
     return path
 
-def user_exists(email):
-    #check if the user exists
+def user_exists(email, revalidate=False):
+    #check if the user exists, before creating one
+    # a probe, which may miss a user registered elsewhere; the create
+    # is conditional, revalidate asks the storage itself
     path = get_user_path(email)
-    fileobj = storage.getFile(path)
-    if not fileobj:
-        return False
-    else:
-        return True
+    return storage.fileExists(path, revalidate)
 
 def get_user(email):
     path = get_user_path(email)
@@ -74,18 +72,19 @@ def set_user(userobj):
     
 def create_user(email, password):
     #create the user if it does not exist
+    # returns True/False, False also when the user exists
     if user_exists(email):
-        return
+        return False
     path = get_user_path(email)
     # assumes userdir exists
     user = User(user=email,password=password)
-    storage.createFile(path,user.get_data())    
+    return storage.createFile(path,user.get_data())
     
 def delete_user(email):
-    # delete the user
-    if not user_exists(email):
-        return
+    # delete the user, read rather than probed, see storage.fileExists
     path = get_user_path(email)
+    if not storage.getFile(path):
+        return
     storage.deleteFile(path)    
 
 def authenticate_user(email, password):
@@ -0,0 +1,1088 @@
+"""
+Storage Backends
+
+key, value stores underneath the storage item API.
+The backend is selected with the STORAGE_BACKEND environment variable:
+
+    s3      - amazon S3 with boto3 (default)
+    local   - one file per key in a local directory
+    sqlite  - a single-file sqlite database
+    memory  - an in-process stand-in for S3, for tests and benchmarks
+"""
+
+import io
+import os
+import json
+import time
+import bisect
+import random
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import urllib.parse
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import (
+        BotoCoreError, ClientError, ConnectionError as BotoConnectionError,
+        HTTPClientError, NoCredentialsError)
+    BOTO3_AVAILABLE = True
+except ImportError:
+    boto3 = None
+    BOTO3_AVAILABLE = False
+
+    # stand-ins so that except clauses still work without botocore
+    class BotoCoreError(Exception):
+        pass
+
+    class HTTPClientError(BotoCoreError):
+        pass
+
+    class BotoConnectionError(BotoCoreError):
+        pass
+
+    class ClientError(Exception):
+        pass
+
+    class NoCredentialsError(Exception):
+        pass
+
+
+# returned by getItemIfChanged when the stored etag still matches
+NOT_MODIFIED = object()
+
+
+def computeEtag(data):
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+class StorageError(Exception):
+    """Raised by a backend when the underlying store fails.
+
+    A missing key is not an error, backends return None for it.
+    """
+
+
+class PreconditionFailed(StorageError):
+    """A conditional put found the key in a state it did not expect."""
+
+
+class TransientError(StorageError):
+    """A failure worth retrying, such as throttling or a timeout.
+
+    ambiguous is True when the request may still have been applied,
+    e.g. the connection dropped while waiting for the response.
+    """
+
+    def __init__(self, message, ambiguous=False):
+        super().__init__(message)
+        self.ambiguous = ambiguous
+
+
+# S3 error codes that mean "try again later"
+S3_TRANSIENT_CODES = {
+    "500", "502", "503", "504", "InternalError", "ServiceUnavailable",
+    "SlowDown", "RequestTimeout", "Throttling", "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
+
+class ItemStream:
+    """A value being read, as returned by openRead.
+
+    read(n) returns up to n bytes, b"" at the end; failures of the
+    underlying stream are raised as StorageError. size is the stored
+    length when the backend knows it.
+    """
+
+    def __init__(self, raw, key, size=None, errors=(), translate=StorageError,
+                 onClose=None):
+        self.raw = raw
+        self.key = key
+        self.size = size
+        self.errors = errors
+        self.translate = translate
+        self.onClose = onClose
+
+    def read(self, n=-1):
+        try:
+            if n is None or n < 0:
+                return self.raw.read()
+            return self.raw.read(n)
+        except self.errors as e:
+            raise self.translate(f"read {self.key}", e) from e
+
+    def close(self):
+        try:
+            self.raw.close()
+        finally:
+            if self.onClose is not None:
+                self.onClose()
+
+
+class SpooledWriter:
+    """openWrite for backends without a streaming put: the value is
+    spooled to a temp file, in memory while small, and put in one
+    piece at commit."""
+
+    def __init__(self, backend, key, metadata, ifNoneMatch, ifMatch):
+        self.backend = backend
+        self.key = key
+        self.metadata = metadata
+        self.ifNoneMatch = ifNoneMatch
+        self.ifMatch = ifMatch
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+
+    def write(self, data):
+        self.spool.write(data)
+
+    def commit(self):
+        try:
+            self.spool.seek(0)
+            return self.backend.putItem(self.key, self.spool.read(),
+                                        self.metadata, self.ifNoneMatch,
+                                        self.ifMatch)
+        finally:
+            self.spool.close()
+
+    def abort(self):
+        self.spool.close()
+
+
+# values spooled by writers stay in memory up to this size
+SPOOL_MAX = 1024 * 1024
+
+
+def rollUp(keys, prefix, delimiter):
+    """Apply listKeys delimiter semantics to sorted keys."""
+    last = None
+    for key in keys:
+        cut = key.find(delimiter, len(prefix)) if delimiter else -1
+        if cut < 0:
+            yield key
+            continue
+        # keys sharing a common prefix are adjacent once sorted
+        common = key[:cut + len(delimiter)]
+        if common != last:
+            last = common
+            yield common
+
+
+def s3Error(what, e):
+    """The StorageError to raise for a boto3 exception."""
+    if isinstance(e, ClientError):
+        if e.response['Error']['Code'] in S3_TRANSIENT_CODES:
+            return TransientError(f"{what}: {e}")
+        return StorageError(f"{what}: {e}")
+    if isinstance(e, (BotoConnectionError, HTTPClientError)):
+        # no response; only a failed connect surely never reached S3
+        return TransientError(f"{what}: {e}",
+                              ambiguous=not isinstance(e, BotoConnectionError))
+    return StorageError(f"{what}: {e}")
+
+
+class StorageBackend:
+    """Interface every backend implements.
+
+    Keys are strings, values are bytes. An item may carry metadata,
+    a small dict of ascii strings stored alongside the value.
+    """
+    name = "base"
+
+    # store value under key and return its new etag,
+    # ifNoneMatch=True only creates, ifMatch=etag only replaces that
+    # version; raises PreconditionFailed when the condition does not
+    # hold and StorageError on failure
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        raise NotImplementedError
+
+    # returns bytes/None, raises StorageError on failure
+    def getItem(self, key):
+        raise NotImplementedError
+
+    # deleting a missing key succeeds, raises StorageError on failure
+    def deleteItem(self, key):
+        raise NotImplementedError
+
+    # conditional get, returns (data, etag, metadata), (None, None, None)
+    # if missing, or (NOT_MODIFIED, etag, None) when etag still matches
+    def getItemIfChanged(self, key, etag=None):
+        data = self.getItem(key)
+        if data is None:
+            return None, None, None
+        newetag = computeEtag(data)
+        if etag is not None and etag == newetag:
+            return NOT_MODIFIED, etag, None
+        return data, newetag, {}
+
+    # yield every key starting with prefix, in sorted order; with a
+    # delimiter, keys containing it after prefix are rolled up into one
+    # "common prefix" ending in the delimiter, as S3 does; startAfter
+    # resumes a listing after that key
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        raise NotImplementedError
+
+    # delete many keys, as few requests as the store allows
+    def deleteItems(self, keys):
+        for key in keys:
+            self.deleteItem(key)
+
+    # streaming get, returns (ItemStream, etag, metadata) or
+    # (None, None, None) if missing; the caller closes the stream
+    def openRead(self, key):
+        data, etag, metadata = self.getItemIfChanged(key)
+        if data is None:
+            return None, None, None
+        return ItemStream(io.BytesIO(data), key, len(data)), etag, metadata
+
+    # streaming put, returns a writer with write(data), commit() that
+    # stores the value and returns its etag, and abort(); the conditions
+    # are those of putItem, checked at commit
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        return SpooledWriter(self, key, metadata, ifNoneMatch, ifMatch)
+
+
+class S3Backend(StorageBackend):
+    name = "s3"
+
+    # values written through openWrite switch to a multipart upload,
+    # in parts of this size, once they outgrow one part; S3 wants 5MB
+    # at least
+    MULTIPART_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, bucket, client=None, resource=None,
+                 multipartBytes=None):
+        if client is None:
+            if not BOTO3_AVAILABLE:
+                raise StorageError("boto3 is required for the s3 backend")
+            try:
+                # retries are done by cloud.storage.resilience, with a
+                # deadline, rather than inside every boto3 call
+                client = boto3.client(
+                    's3',
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                    config=Config(retries={"total_max_attempts": 1}),
+                )
+                resource = boto3.resource(
+                    's3',
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                )
+            except NoCredentialsError:
+                print("Error: AWS credentials not found")
+                client = None
+                resource = None
+        self.bucket = bucket
+        self.client = client
+        self.resource = resource
+        self.multipartBytes = max(5 * 1024 * 1024,
+                                  multipartBytes or self.MULTIPART_BYTES)
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        args = dict(Bucket=self.bucket, Key=key, Body=data,
+                    Metadata=metadata or {})
+        if ifNoneMatch:
+            args["IfNoneMatch"] = "*"
+        if ifMatch is not None:
+            args["IfMatch"] = ifMatch
+        try:
+            response = self.client.put_object(**args)
+            return response.get('ETag') or computeEtag(data)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(f"put {key}: {code}") from e
+            raise s3Error(f"put {key}", e) from e
+        except BotoCoreError as e:
+            raise s3Error(f"put {key}", e) from e
+
+    def getItem(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+            return response['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise s3Error(f"get {key}", e) from e
+        except BotoCoreError as e:
+            raise s3Error(f"get {key}", e) from e
+
+    def deleteItem(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+        except (ClientError, BotoCoreError) as e:
+            raise s3Error(f"delete {key}", e) from e
+
+    def getItemIfChanged(self, key, etag=None):
+        args = dict(Bucket=self.bucket, Key=key)
+        if etag is not None:
+            args["IfNoneMatch"] = etag
+        try:
+            response = self.client.get_object(**args)
+            return (response['Body'].read(), response.get('ETag'),
+                    response.get('Metadata', {}))
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'NoSuchKey':
+                return None, None, None
+            if code in ('304', 'NotModified'):
+                return NOT_MODIFIED, etag, None
+            raise s3Error(f"get {key}", e) from e
+        except BotoCoreError as e:
+            raise s3Error(f"get {key}", e) from e
+
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        args = dict(Bucket=self.bucket, Prefix=prefix)
+        if delimiter:
+            args["Delimiter"] = delimiter
+        if startAfter:
+            args["StartAfter"] = startAfter
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(**args):
+                keys = [obj['Key'] for obj in page.get('Contents', [])]
+                keys += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+                yield from sorted(keys)
+        except (ClientError, BotoCoreError) as e:
+            raise s3Error(f"list {prefix}", e) from e
+
+    # server side copy from another bucket readable with this client,
+    # returns the new etag
+    def copyItem(self, srcBucket, srcKey, key):
+        try:
+            response = self.client.copy_object(
+                Bucket=self.bucket, Key=key,
+                CopySource={"Bucket": srcBucket, "Key": srcKey},
+                MetadataDirective="COPY")
+            return response.get('CopyObjectResult', {}).get('ETag')
+        except (ClientError, BotoCoreError) as e:
+            raise s3Error(f"copy {srcKey}", e) from e
+
+    def openRead(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None, None, None
+            raise s3Error(f"get {key}", e) from e
+        except BotoCoreError as e:
+            raise s3Error(f"get {key}", e) from e
+        stream = ItemStream(response['Body'], key,
+                            response.get('ContentLength'),
+                            (ClientError, BotoCoreError), s3Error)
+        return stream, response.get('ETag'), response.get('Metadata', {})
+
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        return S3Writer(self, key, metadata, ifNoneMatch, ifMatch)
+
+    # DeleteObjects takes up to 1000 keys per request
+    def deleteItems(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i + 1000]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": k} for k in chunk],
+                            "Quiet": True})
+            except (ClientError, BotoCoreError) as e:
+                raise s3Error(f"delete {len(chunk)} keys", e) from e
+            errors = response.get('Errors', [])
+            if errors:
+                raise StorageError(
+                    f"delete {errors[0]['Key']}: {errors[0].get('Message')}"
+                    + (f" and {len(errors) - 1} more" if len(errors) > 1 else ""))
+
+
+class S3Writer:
+    """openWrite for S3. A value that fits one part is a plain put at
+    commit; a larger one becomes a multipart upload, each full part
+    sent as soon as it is written, so at most one part is buffered.
+    The put conditions are applied when the upload is completed.
+
+    Requests go through call(fn, args, safe), which the resilience
+    wrapper replaces with its retrying version; a part stays buffered
+    until it is sent, so resending one is safe.
+    """
+
+    def __init__(self, backend, key, metadata, ifNoneMatch, ifMatch):
+        self.backend = backend
+        self.client = backend.client
+        self.bucket = backend.bucket
+        self.key = key
+        self.metadata = metadata
+        self.ifNoneMatch = ifNoneMatch
+        self.ifMatch = ifMatch
+        self.partSize = backend.multipartBytes
+        self.buffer = bytearray()
+        self.uploadId = None
+        self.parts = []
+
+    @staticmethod
+    def call(fn, args, safe=True):
+        return fn(*args)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.partSize:
+            if self.uploadId is None:
+                self.uploadId = self.call(self.createUpload, ())
+            self.call(self.uploadPart, (self.partSize,))
+
+    def createUpload(self):
+        try:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key,
+                Metadata=self.metadata or {})
+        except (ClientError, BotoCoreError) as e:
+            raise s3Error(f"put {self.key}", e) from e
+        return response['UploadId']
+
+    def uploadPart(self, size):
+        number = len(self.parts) + 1
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                PartNumber=number, Body=bytes(self.buffer[:size]))
+        except (ClientError, BotoCoreError) as e:
+            raise s3Error(f"put {self.key} part {number}", e) from e
+        self.parts.append({"ETag": response['ETag'], "PartNumber": number})
+        del self.buffer[:size]
+
+    def complete(self):
+        args = dict(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                    MultipartUpload={"Parts": self.parts})
+        if self.ifNoneMatch:
+            args["IfNoneMatch"] = "*"
+        if self.ifMatch is not None:
+            args["IfMatch"] = self.ifMatch
+        try:
+            return self.client.complete_multipart_upload(**args).get('ETag')
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(f"put {self.key}: {code}") from e
+            raise s3Error(f"put {self.key}", e) from e
+        except BotoCoreError as e:
+            raise s3Error(f"put {self.key}", e) from e
+
+    def commit(self):
+        conditional = self.ifNoneMatch or self.ifMatch is not None
+        if self.uploadId is None:
+            data, self.buffer = bytes(self.buffer), bytearray()
+            return self.call(self.backend.putItem,
+                             (self.key, data, self.metadata,
+                              self.ifNoneMatch, self.ifMatch),
+                             not conditional)
+        try:
+            if self.buffer:
+                self.call(self.uploadPart, (len(self.buffer),))
+            return self.call(self.complete, (), not conditional)
+        except StorageError:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.uploadId is None:
+            return
+        uploadId, self.uploadId = self.uploadId, None
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=uploadId)
+        except (ClientError, BotoCoreError) as e:
+            # a bucket lifecycle rule cleans up what is left behind
+            print(f"Error aborting upload of {self.key}: {e}")
+
+
+class LocalBackend(StorageBackend):
+    """One file per key under a root directory.
+
+    Conditional puts are atomic between threads of this process only.
+
+    Keys are percent-encoded into file names; keys too long for a file
+    name are stored under their sha256 instead, with the key itself in a
+    "#key" sidecar for listKeys. Metadata goes to a json "#meta" sidecar
+    file next to the value; percent-encoding never produces a "#", so
+    sidecar names cannot clash with value names.
+    """
+    name = "local"
+    MAX_NAME = 240
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def fileEtag(self, fname):
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+    def keyToFile(self, key):
+        name = urllib.parse.quote(key, safe='')
+        if len(name) > self.MAX_NAME:
+            name = "sha256-" + hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, name)
+
+    def writeFile(self, fname, data):
+        # write to a temp file and rename, so readers never see
+        # a partially written value
+        fd, tmpname = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, fname)
+
+    def readMeta(self, fname):
+        try:
+            with open(fname + "#meta", "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        return self.commitItem(key, metadata, ifNoneMatch, ifMatch,
+                               lambda fname: self.writeFile(fname, data))
+
+    # check the put conditions and store the sidecars, then install(fname)
+    # puts the value itself in place
+    def commitItem(self, key, metadata, ifNoneMatch, ifMatch, install):
+        fname = self.keyToFile(key)
+        with self.lock:
+            current = self.fileEtag(fname)
+            if ifNoneMatch and current is not None:
+                raise PreconditionFailed(f"put {key}: exists")
+            if ifMatch is not None and current != ifMatch:
+                raise PreconditionFailed(f"put {key}: etag mismatch")
+            try:
+                if metadata:
+                    self.writeFile(fname + "#meta",
+                                   json.dumps(metadata).encode('utf-8'))
+                elif os.path.exists(fname + "#meta"):
+                    os.remove(fname + "#meta")
+                if os.path.basename(fname).startswith("sha256-") and \
+                        current is None:
+                    self.writeFile(fname + "#key", key.encode('utf-8'))
+                install(fname)
+            except OSError as e:
+                raise StorageError(f"put {key}: {e}") from e
+            return self.fileEtag(fname)
+
+    def getItem(self, key):
+        try:
+            with open(self.keyToFile(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise StorageError(f"get {key}: {e}") from e
+
+    def deleteItem(self, key):
+        fname = self.keyToFile(key)
+        try:
+            with self.lock:
+                os.remove(fname)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise StorageError(f"delete {key}: {e}") from e
+        for sidecar in ("#meta", "#key"):
+            try:
+                os.remove(fname + sidecar)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                raise StorageError(f"delete {key}: {e}") from e
+
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        keys = []
+        try:
+            for entry in os.scandir(self.root):
+                name = entry.name
+                if "#" in name or name.startswith(".tmp-"):
+                    continue
+                if name.startswith("sha256-"):
+                    try:
+                        with open(entry.path + "#key", "rb") as f:
+                            key = f.read().decode('utf-8')
+                    except FileNotFoundError:
+                        continue
+                else:
+                    key = urllib.parse.unquote(name)
+                if key.startswith(prefix) and \
+                        (startAfter is None or key > startAfter):
+                    keys.append(key)
+        except OSError as e:
+            raise StorageError(f"list {prefix}: {e}") from e
+        yield from rollUp(sorted(keys), prefix, delimiter)
+
+    def openRead(self, key):
+        fname = self.keyToFile(key)
+        try:
+            f = open(fname, "rb")
+        except FileNotFoundError:
+            return None, None, None
+        except OSError as e:
+            raise StorageError(f"get {key}: {e}") from e
+        try:
+            st = os.fstat(f.fileno())
+            metadata = self.readMeta(fname)
+        except (OSError, ValueError) as e:
+            f.close()
+            raise StorageError(f"get {key}: {e}") from e
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        return ItemStream(f, key, st.st_size, (OSError,)), etag, metadata
+
+    # written straight to a temp file, renamed into place at commit
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        return LocalWriter(self, key, metadata, ifNoneMatch, ifMatch)
+
+    # values are replaced by rename, so mtime and size identify a version
+    # and revalidation only needs a stat
+    def getItemIfChanged(self, key, etag=None):
+        fname = self.keyToFile(key)
+        try:
+            with open(fname, "rb") as f:
+                st = os.fstat(f.fileno())
+                newetag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+                if etag is not None and etag == newetag:
+                    return NOT_MODIFIED, etag, None
+                return f.read(), newetag, self.readMeta(fname)
+        except FileNotFoundError:
+            return None, None, None
+        except OSError as e:
+            raise StorageError(f"get {key}: {e}") from e
+
+
+class LocalWriter:
+    def __init__(self, backend, key, metadata, ifNoneMatch, ifMatch):
+        self.backend = backend
+        self.key = key
+        self.args = (metadata, ifNoneMatch, ifMatch)
+        try:
+            fd, self.tmpname = tempfile.mkstemp(dir=backend.root,
+                                                prefix=".tmp-")
+            self.file = os.fdopen(fd, "wb")
+        except OSError as e:
+            raise StorageError(f"put {key}: {e}") from e
+
+    def write(self, data):
+        try:
+            self.file.write(data)
+        except OSError as e:
+            self.abort()
+            raise StorageError(f"put {self.key}: {e}") from e
+
+    def commit(self):
+        try:
+            self.file.close()
+            return self.backend.commitItem(
+                self.key, *self.args,
+                lambda fname: os.replace(self.tmpname, fname))
+        except OSError as e:
+            raise StorageError(f"put {self.key}: {e}") from e
+        finally:
+            self.abort()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmpname)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing {self.tmpname}: {e}")
+
+
+def sqliteError(what, e):
+    """The StorageError to raise for a sqlite3 exception."""
+    if isinstance(e, sqlite3.OperationalError) and \
+            ("locked" in str(e) or "busy" in str(e)):
+        # the statement was rolled back, safe to retry
+        return TransientError(f"{what}: {e}")
+    return StorageError(f"{what}: {e}")
+
+
+class SQLiteBackend(StorageBackend):
+    """All keys in one table of a single sqlite database file.
+
+    sqlite connections cannot be shared across threads, so every
+    thread of the storage executor gets its own connection.
+    """
+    name = "sqlite"
+
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS items "
+                         "(key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                         "etag TEXT, meta TEXT)")
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(items)")]
+            if "etag" not in columns:
+                conn.execute("ALTER TABLE items ADD COLUMN etag TEXT")
+            if "meta" not in columns:
+                conn.execute("ALTER TABLE items ADD COLUMN meta TEXT")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbpath, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        etag = computeEtag(data)
+        self.storeRow(key, "?", sqlite3.Binary(data), etag, metadata,
+                      ifNoneMatch, ifMatch)
+        return etag
+
+    # insert or update the row of key under the put conditions, with
+    # value the sql expression for data and arg its parameter; fill, if
+    # given, is then called in the same transaction with the rowid
+    def storeRow(self, key, value, arg, etag, metadata, ifNoneMatch,
+                 ifMatch, fill=None):
+        row = (arg, etag, json.dumps(metadata) if metadata else None)
+        try:
+            conn = self.connection()
+            with conn:
+                if ifMatch is not None:
+                    cursor = conn.execute(
+                        f"UPDATE items SET data = {value}, etag = ?, meta = ? "
+                        "WHERE key = ? AND etag = ?", row + (key, ifMatch))
+                    if cursor.rowcount == 0:
+                        raise PreconditionFailed(f"put {key}: etag mismatch")
+                elif ifNoneMatch:
+                    conn.execute("INSERT INTO items (data, etag, meta, key) "
+                                 f"VALUES ({value}, ?, ?, ?)", row + (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO items "
+                                 f"(data, etag, meta, key) VALUES ({value}, ?, ?, ?)",
+                                 row + (key,))
+                if fill is not None:
+                    (rowid,) = conn.execute(
+                        "SELECT rowid FROM items WHERE key = ?",
+                        (key,)).fetchone()
+                    fill(conn, rowid)
+        except sqlite3.IntegrityError as e:
+            raise PreconditionFailed(f"put {key}: exists") from e
+        except sqlite3.Error as e:
+            raise sqliteError(f"put {key}", e) from e
+
+    def getItem(self, key):
+        try:
+            row = self.connection().execute(
+                "SELECT data FROM items WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            raise sqliteError(f"get {key}", e) from e
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def deleteItem(self, key):
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute("DELETE FROM items WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            raise sqliteError(f"delete {key}", e) from e
+
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        # keyset pagination over the primary key, s + U+10FFFF sorts
+        # after every key that starts with s; a rolled up common prefix
+        # is skipped over in one query the same way
+        upper = prefix + "\U0010ffff"
+        last, op = prefix, ">="
+        if startAfter is not None and startAfter >= prefix:
+            last, op = startAfter, ">"
+        while True:
+            try:
+                rows = self.connection().execute(
+                    f"SELECT key FROM items WHERE key {op} ? AND key < ? "
+                    "ORDER BY key LIMIT 1000", (last, upper)).fetchall()
+            except sqlite3.Error as e:
+                raise sqliteError(f"list {prefix}", e) from e
+            if not rows:
+                return
+            for (key,) in rows:
+                cut = key.find(delimiter, len(prefix)) if delimiter else -1
+                if cut >= 0:
+                    common = key[:cut + len(delimiter)]
+                    yield common
+                    last, op = common + "\U0010ffff", ">="
+                    break
+                yield key
+                last, op = key, ">"
+
+    def deleteItems(self, keys):
+        keys = list(keys)
+        try:
+            conn = self.connection()
+            with conn:
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    conn.execute("DELETE FROM items WHERE key IN (%s)"
+                                 % ",".join("?" * len(chunk)), chunk)
+        except sqlite3.Error as e:
+            raise sqliteError(f"delete {len(keys)} keys", e) from e
+
+    # incremental blob I/O needs python 3.11, older ones read and write
+    # values whole
+    def openRead(self, key):
+        if not hasattr(sqlite3.Connection, "blobopen"):
+            return super().openRead(key)
+        # a connection of its own, the stream may be read from any thread;
+        # its open blob keeps the row as it was when opened
+        conn = None
+        try:
+            conn = sqlite3.connect(self.dbpath, timeout=30,
+                                   check_same_thread=False)
+            row = conn.execute(
+                "SELECT rowid, etag, meta, length(data) FROM items "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                conn.close()
+                return None, None, None
+            if row[1] is None:
+                # rows from before etags were stored compute theirs
+                conn.close()
+                return super().openRead(key)
+            blob = conn.blobopen("items", "data", row[0], readonly=True)
+        except sqlite3.Error as e:
+            if conn is not None:
+                conn.close()
+            raise sqliteError(f"get {key}", e) from e
+        stream = ItemStream(blob, key, row[3], (sqlite3.Error,), sqliteError,
+                            onClose=conn.close)
+        return stream, row[1], json.loads(row[2] or "{}")
+
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        if not hasattr(sqlite3.Connection, "blobopen"):
+            return super().openWrite(key, metadata, ifNoneMatch, ifMatch)
+        return SQLiteWriter(self, key, metadata, ifNoneMatch, ifMatch)
+
+    def getItemIfChanged(self, key, etag=None):
+        try:
+            conn = self.connection()
+            row = conn.execute(
+                "SELECT etag FROM items WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None, None
+            if etag is not None and row[0] == etag:
+                return NOT_MODIFIED, etag, None
+            row = conn.execute(
+                "SELECT data, etag, meta FROM items WHERE key = ?",
+                (key,)).fetchone()
+        except sqlite3.Error as e:
+            raise sqliteError(f"get {key}", e) from e
+        if row is None:
+            return None, None, None
+        data = bytes(row[0])
+        return data, row[1] or computeEtag(data), json.loads(row[2] or "{}")
+
+
+class SQLiteWriter:
+    """openWrite for sqlite. The value is spooled to a temp file while
+    it is written, then copied into a zeroblob of its final size in
+    chunks, so neither step holds it in memory whole."""
+
+    CHUNK = 1024 * 1024
+
+    def __init__(self, backend, key, metadata, ifNoneMatch, ifMatch):
+        self.backend = backend
+        self.key = key
+        self.args = (metadata, ifNoneMatch, ifMatch)
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.spool.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def fill(self, conn, rowid):
+        self.spool.seek(0)
+        with conn.blobopen("items", "data", rowid) as blob:
+            while True:
+                chunk = self.spool.read(self.CHUNK)
+                if not chunk:
+                    break
+                blob.write(chunk)
+
+    def commit(self):
+        etag = '"' + self.md5.hexdigest() + '"'
+        try:
+            self.backend.storeRow(self.key, "zeroblob(?)", self.size, etag,
+                                  *self.args, fill=self.fill)
+        finally:
+            self.spool.close()
+        return etag
+
+    def abort(self):
+        self.spool.close()
+
+
+class MemoryBackend(StorageBackend):
+    """An in-process stand-in for S3, holding everything in a dict.
+
+    It keeps to S3's behaviour where the storage layer relies on it:
+    md5 etags, conditional puts and gets, lower-cased metadata limited
+    to 2KB, listings in pages of 1000 keys or common prefixes, and
+    deletes of up to 1000 keys per request. Each request can be given
+    a latency, latency seconds plus an exponentially distributed
+    jitter with mean jitter seconds, and fails with probability
+    errorRate. A failed read, or a failed write that did not apply,
+    raises TransientError; half the failed writes apply first and then
+    raise an ambiguous TransientError, as a dropped response would.
+    requests counts the requests made, by kind.
+    """
+    name = "memory"
+    PAGE_SIZE = 1000
+    MAX_METADATA = 2048
+
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.items = {}   # key -> (data, etag, metadata)
+        self.keys = []    # sorted, for listings
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    # one round trip; returns True when the request is to fail
+    def request(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            delay = self.latency
+            if self.jitter:
+                delay += self.random.expovariate(1 / self.jitter)
+            fail = self.errorRate and self.random.random() < self.errorRate
+            ambiguous = fail and self.random.random() < 0.5
+        if delay:
+            time.sleep(delay)
+        if fail and not ambiguous:
+            raise TransientError(f"{kind}: injected failure")
+        return fail
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        metadata = {str(k).lower(): str(v) for k, v in (metadata or {}).items()}
+        if sum(len(k) + len(v) for k, v in metadata.items()) > self.MAX_METADATA:
+            raise StorageError(f"put {key}: MetadataTooLarge")
+        fail = self.request("put")
+        etag = computeEtag(data)
+        with self.lock:
+            current = self.items.get(key)
+            if ifNoneMatch and current is not None:
+                raise PreconditionFailed(f"put {key}: PreconditionFailed")
+            if ifMatch is not None and (current is None or current[1] != ifMatch):
+                raise PreconditionFailed(f"put {key}: PreconditionFailed")
+            if current is None:
+                bisect.insort(self.keys, key)
+            self.items[key] = (bytes(data), etag, metadata)
+        if fail:
+            raise TransientError(f"put {key}: injected failure", ambiguous=True)
+        return etag
+
+    def getItem(self, key):
+        data, _, _ = self.getItemIfChanged(key)
+        return data
+
+    def getItemIfChanged(self, key, etag=None):
+        fail = self.request("get")
+        if fail:
+            raise TransientError(f"get {key}: injected failure", ambiguous=True)
+        with self.lock:
+            current = self.items.get(key)
+        if current is None:
+            return None, None, None
+        if etag is not None and current[1] == etag:
+            return NOT_MODIFIED, etag, None
+        return current[0], current[1], dict(current[2])
+
+    def remove(self, key):
+        if self.items.pop(key, None) is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def deleteItem(self, key):
+        fail = self.request("delete")
+        with self.lock:
+            self.remove(key)
+        if fail:
+            raise TransientError(f"delete {key}: injected failure", ambiguous=True)
+
+    def deleteItems(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            fail = self.request("deletemany")
+            with self.lock:
+                for key in keys[i:i + 1000]:
+                    self.remove(key)
+            if fail:
+                raise TransientError(f"delete {len(keys)} keys: injected failure",
+                                     ambiguous=True)
+
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        # the listing resumes after this bound, past a whole common prefix
+        # once one is returned
+        after = startAfter if startAfter is not None and startAfter >= prefix else None
+        while True:
+            if self.request("list"):
+                raise TransientError(f"list {prefix}: injected failure",
+                                     ambiguous=True)
+            page = []
+            with self.lock:
+                if after is None:
+                    i = bisect.bisect_left(self.keys, prefix)
+                else:
+                    i = bisect.bisect_right(self.keys, after)
+                while i < len(self.keys) and len(page) < self.PAGE_SIZE:
+                    key = self.keys[i]
+                    if not key.startswith(prefix):
+                        break
+                    cut = key.find(delimiter, len(prefix)) if delimiter else -1
+                    if cut >= 0:
+                        key = key[:cut + len(delimiter)]
+                        after = key + "\U0010ffff"
+                        i = bisect.bisect_right(self.keys, after)
+                    else:
+                        after = key
+                        i += 1
+                    page.append(key)
+                more = i < len(self.keys) and self.keys[i].startswith(prefix)
+            yield from page
+            if not more:
+                return
+
+
+def createBackend(name=None):
+    """Build the backend named by name, or by STORAGE_BACKEND."""
+    name = (name or os.getenv("STORAGE_BACKEND", "s3")).lower()
+    if name == "s3":
+        return S3Backend(os.getenv("S3_BUCKET_NAME"),
+                         multipartBytes=int(os.getenv("STORAGE_MULTIPART_BYTES", "0")))
+    if name == "local":
+        return LocalBackend(os.getenv("STORAGE_LOCAL_ROOT", "storage-data"))
+    if name == "sqlite":
+        return SQLiteBackend(os.getenv("STORAGE_SQLITE_PATH", "storage.db"))
+    if name == "memory":
+        return MemoryBackend(
+            latency=float(os.getenv("STORAGE_MEMORY_LATENCY_MS", "0")) / 1000,
+            jitter=float(os.getenv("STORAGE_MEMORY_JITTER_MS", "0")) / 1000,
+            errorRate=float(os.getenv("STORAGE_MEMORY_ERROR_RATE", "0")))
+    raise ValueError(f"Unknown storage backend: {name}")
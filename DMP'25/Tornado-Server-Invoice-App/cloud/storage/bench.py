@@ -0,0 +1,194 @@
+"""
+Storage Benchmarks
+
+Times the file API against the in-memory S3 stand-in as a directory
+grows, so that changes to the directory algorithms show up as numbers:
+
+    python -m cloud.storage.bench --sizes 10,100,1000,10000,100000 \\
+        --ops 200 --latency-ms 5 --jitter-ms 2 --output bench.json
+
+For every size a fresh MemoryBackend, wrapped for retries as the
+app's backend is, is filled with a directory of that many files,
+then createFile, getFile, updateFile, deleteFile, full listings
+(getFile of the directory) and first pages of listDirPage are timed.
+Each operation is reported with its latency percentiles and the
+backend requests it made per call, by kind; the request counts do not
+depend on the machine, so they are the numbers to compare between
+runs. Everything runs in process and offline, with
+the storage configuration of the environment (cache, key layout,
+segment size, ...) apart from the backend.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+# the backend configured at import is replaced below; never reach out
+# to a real bucket for it
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+from cloud.storage import storage  # noqa: E402
+from cloud.storage.backends import MemoryBackend  # noqa: E402
+
+USER = "bench@example.com"
+# files created per Batch while filling a directory
+SEED_BATCH = 1000
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.payload = "x" * args.file_bytes
+        self.rng = random.Random(args.seed)
+
+    # the directory is filled without injected latency and errors,
+    # they are turned on for the timed calls only
+    def newBackend(self):
+        self.backend = MemoryBackend(seed=self.args.seed)
+        # retried as configured, as the app's backend is
+        storage.setBackend(self.backend)
+        if self.args.no_cache:
+            storage.cache = None
+
+    def fill(self, path, size):
+        for start in range(0, size, SEED_BATCH):
+            batch = storage.Batch()
+            for i in range(start, min(size, start + SEED_BATCH)):
+                batch.createFile(path + [f"f{i:06d}"], self.payload)
+            if not batch.commit():
+                raise RuntimeError(f"filling {size} files failed at {start}")
+
+    def measure(self, calls):
+        """Time fn() for every fn in calls, the stats of the lot."""
+        before = dict(self.backend.requests)
+        times = []
+        failures = 0
+        for fn in calls:
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+            if result is None or result is False:
+                failures += 1
+        times.sort()
+        requests = {
+            kind: round((count - before.get(kind, 0)) / len(times), 2)
+            for kind, count in sorted(self.backend.requests.items())
+            if count != before.get(kind, 0)}
+
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+        return {
+            "calls": len(times),
+            "failures": failures,
+            "meanMs": ms(sum(times) / len(times)),
+            "p50Ms": ms(percentile(times, 0.5)),
+            "p95Ms": ms(percentile(times, 0.95)),
+            "p99Ms": ms(percentile(times, 0.99)),
+            "maxMs": ms(times[-1]),
+            "requestsPerCall": requests,
+        }
+
+    def runSize(self, size):
+        self.newBackend()
+        path = ["home", USER, f"dir{size}"]
+        start = time.perf_counter()
+        self.fill(path, size)
+        filled = time.perf_counter() - start
+        self.backend.latency = self.args.latency_ms / 1000
+        self.backend.jitter = self.args.jitter_ms / 1000
+        self.backend.errorRate = self.args.error_rate
+        ops = self.args.ops
+        existing = [path + [f"f{self.rng.randrange(size):06d}"] for _ in range(ops)]
+        created = [path + [f"new{i:06d}"] for i in range(ops)]
+        repeat = self.args.list_repeat
+        results = {
+            "createFile": self.measure(
+                lambda p=p: storage.createFile(p, self.payload) for p in created),
+            "getFile": self.measure(
+                lambda p=p: storage.getFile(p) for p in existing),
+            "updateFile": self.measure(
+                lambda p=p: storage.updateFile(p, self.payload) for p in existing),
+            "deleteFile": self.measure(
+                lambda p=p: storage.deleteFile(p) for p in created),
+            "listDir": self.measure(
+                lambda: storage.getFile(path) for _ in range(repeat)),
+            "listDirPage": self.measure(
+                lambda: storage.listDirPage(path, None, 100)[0]
+                for _ in range(repeat)),
+        }
+        return {"size": size, "fillSeconds": round(filled, 3), "ops": results}
+
+    def run(self):
+        report = {
+            "config": {
+                "sizes": self.args.sizes,
+                "ops": self.args.ops,
+                "fileBytes": self.args.file_bytes,
+                "latencyMs": self.args.latency_ms,
+                "jitterMs": self.args.jitter_ms,
+                "errorRate": self.args.error_rate,
+                "cache": not self.args.no_cache,
+                "keyLayout": storage.STORAGE_KEY_LAYOUT,
+                "dirSegmentSize": storage.DIR_SEGMENT_SIZE,
+                "python": sys.version.split()[0],
+            },
+            "results": [],
+        }
+        for size in self.args.sizes:
+            result = self.runSize(size)
+            report["results"].append(result)
+            print(f"{size:>8} files, filled in {result['fillSeconds']}s")
+            for op, stats in result["ops"].items():
+                requests = sum(stats["requestsPerCall"].values())
+                print(f"    {op:<12} p50 {stats['p50Ms']:>9}ms  "
+                      f"p99 {stats['p99Ms']:>9}ms  {requests:>7} requests/call"
+                      + (f"  {stats['failures']} failed" if stats["failures"] else ""))
+        return report
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m cloud.storage.bench",
+        description="Time the storage file API against an in-memory S3 "
+                    "as directories grow.")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        type=lambda s: [int(n) for n in s.split(",")],
+                        help="comma separated directory sizes")
+    parser.add_argument("--ops", type=int, default=100,
+                        help="calls timed per operation and size")
+    parser.add_argument("--list-repeat", type=int, default=5,
+                        help="calls timed per listing and size")
+    parser.add_argument("--file-bytes", type=int, default=1024)
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="injected latency per backend request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0,
+                        help="mean of the exponential jitter added to it")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of backend requests that fail")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run without the in-process item cache")
+    parser.add_argument("--output", help="file to write the json report to")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    report = Bench(args).run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
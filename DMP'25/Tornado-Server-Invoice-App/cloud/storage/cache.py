@@ -0,0 +1,214 @@
+"""
+Storage Item Cache
+
+In-process read-through cache for the storage item API.
+Entries are keyed by storage key, bounded by a byte budget and evicted
+least recently used first. An entry younger than ttl seconds is served
+as is; an older one is revalidated with a conditional get using the
+etag it was stored with.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ("value", "etag", "size", "fetched")
+
+    def __init__(self, value, etag, size, fetched):
+        self.value = value
+        self.etag = etag
+        self.size = size
+        self.fetched = fetched
+
+
+class ItemCache:
+    def __init__(self, maxBytes, ttl):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # bumped by every invalidation, see token()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, key):
+        """Return the CacheEntry for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def fresh(self, entry):
+        return time.monotonic() - entry.fetched < self.ttl
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def token(self):
+        """Taken before a backend read and handed back to put().
+
+        A write that lands while the read is in flight invalidates
+        the key before the read result arrives; the token lets put()
+        notice that and not cache the older value.
+        """
+        with self.lock:
+            return self.writes
+
+    # value is what the cache hands back, size is its stored byte size
+    def put(self, key, value, etag, size, token=None):
+        if size > self.maxBytes:
+            self.invalidate(key)
+            return
+        with self.lock:
+            if token is not None and token != self.writes:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = CacheEntry(value, etag, size, time.monotonic())
+            self.size += size
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def revalidated(self, key, entry):
+        """The backend confirmed entry is still current."""
+        with self.lock:
+            self.revalidations += 1
+            entry.fetched = time.monotonic()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.writes += 1
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+
+    def clear(self):
+        with self.lock:
+            self.writes += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+            }
+
+
+class KeyMemo:
+    """Bounded, thread-safe LRU map remembering small facts about keys,
+    such as which directories exist or the etag of the last write."""
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, default)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value=True):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one call.
+
+    Every write calls forget(): callers arriving after it start a new
+    call instead of joining one that may return the value from before
+    the write.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.shared = 0
+
+    def run(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.done.set()
+
+    def token(self):
+        """Changes whenever forget() is called, see runShared."""
+        with self.lock:
+            return self.writes
+
+    def joined(self):
+        with self.lock:
+            self.shared += 1
+
+    def forget(self, key):
+        with self.lock:
+            self.writes += 1
+            self.calls.pop(key, None)
+
+    def clear(self):
+        """Calls in flight are not joined any more."""
+        with self.lock:
+            self.writes += 1
+            self.calls.clear()
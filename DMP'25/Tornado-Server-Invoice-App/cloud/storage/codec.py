@@ -0,0 +1,226 @@
+"""
+Storage Compression
+
+Transparent compression of stored values. A compressed value starts
+with a four byte magic header naming its codec:
+
+    \\x00SZz   zstd frame (needs the zstandard package)
+    \\x00SZg   gzip (zlib) stream
+    \\x00SZn   stored as is
+
+followed by the payload. Reads, whole with decode or streamed through
+DecodingStream, detect the header, so values written
+before compression, or with it off, are returned unchanged. A value
+that happens to begin with the magic is written with the "stored"
+header so that it can never be mistaken for a compressed one.
+
+Values shorter than the threshold, or that do not shrink (images and
+other already compressed uploads), are written plain. Configured from
+the environment by fromEnv:
+
+    STORAGE_COMPRESSION           - auto, off, gzip or zstd
+    STORAGE_COMPRESSION_MIN_BYTES - smallest value worth compressing
+    STORAGE_COMPRESSION_LEVEL     - codec level, default per codec
+
+auto picks per backend: S3 and sqlite compress, with zstd when it is
+installed and gzip otherwise, while a local directory stays plain
+since there local disk is cheaper than the CPU.
+"""
+
+import os
+import zlib
+import threading
+
+try:
+    import zstandard
+    from zstandard import ZstdError
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+    # stand-in so that except clauses still work without zstandard
+    class ZstdError(Exception):
+        pass
+
+MAGIC = b"\x00SZ"
+ZSTD = b"z"
+GZIP = b"g"
+STORED = b"n"
+HEADER_SIZE = len(MAGIC) + 1
+
+DEFAULT_LEVELS = {"zstd": 3, "gzip": 6}
+# backend name -> codec used with STORAGE_COMPRESSION=auto
+BACKEND_DEFAULTS = {"s3": "zstd", "sqlite": "zstd", "local": "off"}
+
+
+class Codec:
+    def __init__(self, name="off", minBytes=1024, level=None):
+        if name == "zstd" and not ZSTD_AVAILABLE:
+            print("zstandard is not installed, compressing with gzip")
+            name = "gzip"
+        if name not in ("off", "gzip", "zstd"):
+            raise ValueError(f"Unknown storage compression: {name}")
+        self.name = name
+        self.minBytes = minBytes
+        self.level = level if level is not None else DEFAULT_LEVELS.get(name)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counters = {"compressed": 0, "plain": 0,
+                         "bytesIn": 0, "bytesOut": 0}
+
+    def count(self, compressed, size, stored):
+        with self.lock:
+            self.counters["compressed" if compressed else "plain"] += 1
+            self.counters["bytesIn"] += size
+            self.counters["bytesOut"] += stored
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, codec=self.name)
+
+    # zstandard contexts are not thread safe, keep one per thread
+    def compressor(self):
+        ctx = getattr(self.local, "compressor", None)
+        if ctx is None:
+            ctx = self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return ctx
+
+    def encode(self, data):
+        """The bytes to store for data."""
+        size = len(data)
+        if self.name != "off" and size >= self.minBytes:
+            if self.name == "zstd":
+                packed = MAGIC + ZSTD + self.compressor().compress(data)
+            else:
+                packed = MAGIC + GZIP + zlib.compress(data, self.level)
+            if len(packed) < size:
+                self.count(True, size, len(packed))
+                return packed
+        if data[:len(MAGIC)] == MAGIC:
+            data = MAGIC + STORED + data
+        self.count(False, size, len(data))
+        return data
+
+
+def isEncoded(data):
+    return data is not None and data[:len(MAGIC)] == MAGIC
+
+
+_local = threading.local()
+
+
+def decode(data):
+    """The value stored as data, which need not be compressed.
+    Raises ValueError for a corrupt or unreadable payload."""
+    if not isEncoded(data):
+        return data
+    kind = data[len(MAGIC):HEADER_SIZE]
+    payload = data[HEADER_SIZE:]
+    if kind == STORED:
+        return payload
+    if kind == GZIP:
+        try:
+            return zlib.decompress(payload)
+        except zlib.error as e:
+            raise ValueError(f"corrupt gzip value: {e}") from e
+    if kind == ZSTD:
+        if not ZSTD_AVAILABLE:
+            raise ValueError("zstd value but zstandard is not installed")
+        ctx = getattr(_local, "decompressor", None)
+        if ctx is None:
+            ctx = _local.decompressor = zstandard.ZstdDecompressor()
+        try:
+            # frames written by compress() carry their content size
+            return ctx.decompress(payload)
+        except ZstdError as e:
+            raise ValueError(f"corrupt zstd value: {e}") from e
+    raise ValueError(f"unknown storage codec {kind!r}")
+
+
+def fromEnv(backendName):
+    """The codec configured for a backend of the given name."""
+    name = os.getenv("STORAGE_COMPRESSION", "auto").lower()
+    if name == "auto":
+        name = BACKEND_DEFAULTS.get(backendName, "off")
+        if name == "zstd" and not ZSTD_AVAILABLE:
+            name = "gzip"
+    level = os.getenv("STORAGE_COMPRESSION_LEVEL")
+    return Codec(
+        name,
+        minBytes=int(os.getenv("STORAGE_COMPRESSION_MIN_BYTES", "1024")),
+        level=int(level) if level else None)
+
+
+class DecodingStream:
+    """Reads the value out of a stream of stored bytes, as decode does
+    for a whole value. A plain value is passed through as it is read;
+    a compressed one is inflated a chunk at a time. Raises ValueError
+    for a corrupt or unreadable payload. size is the length of the
+    value when the stored length is given and tells it."""
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, raw, size=None):
+        self.raw = raw
+        self.size = None
+        self.pending = bytearray()
+        self.inflate = None
+        self.eof = False
+        head = b""
+        while len(head) < HEADER_SIZE:
+            more = raw.read(HEADER_SIZE - len(head))
+            if not more:
+                break
+            head += more
+        # whether the stored bytes are the value itself
+        self.plain = not isEncoded(head)
+        if self.plain:
+            self.pending += head
+            self.size = size
+            return
+        kind = head[len(MAGIC):]
+        if kind == STORED and size is not None:
+            self.size = size - HEADER_SIZE
+        elif kind == GZIP:
+            self.inflate = zlib.decompressobj()
+        elif kind == ZSTD and ZSTD_AVAILABLE:
+            self.inflate = zstandard.ZstdDecompressor().decompressobj()
+        elif kind == ZSTD:
+            raise ValueError("zstd value but zstandard is not installed")
+        elif kind != STORED:
+            raise ValueError(f"unknown storage codec {kind!r}")
+
+    def fill(self, n):
+        while (n < 0 or len(self.pending) < n) and not self.eof:
+            chunk = self.raw.read(self.CHUNK)
+            try:
+                if not chunk:
+                    self.eof = True
+                    flush = getattr(self.inflate, "flush", None)
+                    if flush is not None:
+                        self.pending += flush()
+                elif self.inflate is not None:
+                    self.pending += self.inflate.decompress(chunk)
+                else:
+                    self.pending += chunk
+            except zlib.error as e:
+                raise ValueError(f"corrupt gzip value: {e}") from e
+            except ZstdError as e:
+                raise ValueError(f"corrupt zstd value: {e}") from e
+
+    def read(self, n=-1):
+        if n is None:
+            n = -1
+        if self.inflate is None and not self.pending:
+            # nothing to undo, read straight through
+            return self.raw.read(n)
+        self.fill(n)
+        if n < 0:
+            n = len(self.pending)
+        data = bytes(self.pending[:n])
+        del self.pending[:n]
+        return data
+
+    def close(self):
+        self.raw.close()
@@ -0,0 +1,195 @@
+"""
+Storage Disk Cache
+
+On-disk tier under the in-process item cache, so warm items survive a
+restart and are shared by the worker processes of one host.
+
+Each entry is one file, named by the sha256 of its key and fanned out
+into 256 subdirectories, holding a small json header (key, etag,
+metadata) followed by the value. Entries are written to a temp file
+and renamed into place, so readers in any process see either the old
+or the new file.
+
+Eviction is least recently used under a byte cap shared by the
+processes using the directory. Each process keeps an index ordered by
+mtime, hits touch the file's mtime, and every RESCAN_SECONDS a put
+rebuilds the index from a scan of the whole directory and evicts the
+oldest files whoever wrote them. Between two scans a process only
+counts its own writes, so the directory can exceed the cap by what the
+others write in that time.
+
+A cached entry is only as good as its etag: the storage layer still
+revalidates it with a conditional get, which costs a round trip but
+no transfer of the value.
+"""
+
+import os
+import json
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+HEADER = struct.Struct(">I")
+
+
+class DiskCache:
+    RESCAN_SECONDS = 60
+
+    def __init__(self, root, maxBytes):
+        self.root = os.path.abspath(root)
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # file name -> size
+        self.size = 0
+        self.scanned = 0.0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        """Rebuild the index from the files of every process, then
+        evict down to the cap."""
+        self.scanned = time.monotonic()
+        found = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime_ns, entry.path, st.st_size))
+        found.sort()
+        with self.lock:
+            self.entries = OrderedDict((fname, size) for _, fname, size in found)
+            self.size = sum(size for _, _, size in found)
+        self.evict()
+
+    def keyToFile(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """Returns (data, etag, metadata) or None."""
+        fname = self.keyToFile(key)
+        try:
+            with open(fname, "rb") as f:
+                st = os.fstat(f.fileno())
+                (hlen,) = HEADER.unpack(f.read(HEADER.size))
+                header = json.loads(f.read(hlen))
+                if header["key"] != key:
+                    raise ValueError("sha256 collision")
+                data = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.forget(fname)
+            return None
+        except (OSError, ValueError, KeyError, struct.error):
+            # torn or foreign file, drop it
+            self.invalidate(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+            if fname in self.entries:
+                self.entries.move_to_end(fname)
+            else:
+                # written by another process
+                self.entries[fname] = st.st_size
+                self.size += st.st_size
+        self.evict()
+        return data, header["etag"], header["metadata"]
+
+    def put(self, key, data, etag, metadata):
+        header = json.dumps({"key": key, "etag": etag,
+                             "metadata": metadata}).encode('utf-8')
+        size = HEADER.size + len(header) + len(data)
+        if size > self.maxBytes // 8:
+            return
+        fname = self.keyToFile(key)
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname),
+                                           prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(len(header)))
+                f.write(header)
+                f.write(data)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            print(f"Error writing disk cache: {e}")
+            return
+        with self.lock:
+            self.forget(fname)
+            self.entries[fname] = size
+            self.size += size
+        if time.monotonic() - self.scanned >= self.RESCAN_SECONDS:
+            self.scan()
+        else:
+            self.evict()
+
+    def invalidate(self, key):
+        fname = self.keyToFile(key)
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error invalidating disk cache: {e}")
+        with self.lock:
+            self.forget(fname)
+
+    def clear(self):
+        """Drop every entry, those of other processes included."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    # lock held
+    def forget(self, fname):
+        size = self.entries.pop(fname, None)
+        if size is not None:
+            self.size -= size
+
+    def evict(self):
+        victims = []
+        with self.lock:
+            while self.size > self.maxBytes and self.entries:
+                fname, size = self.entries.popitem(last=False)
+                self.size -= size
+                victims.append(fname)
+        for fname in victims:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
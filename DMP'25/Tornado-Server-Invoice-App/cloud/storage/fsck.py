@@ -0,0 +1,617 @@
+"""
+Storage Consistency Check
+
+Finds, and with --repair removes, what an interrupted write leaves
+behind in the storage tree:
+
+    python -m cloud.storage.fsck --store s3://bucket --workers 32 \\
+        --rate 500 --checkpoint fsck.ckpt            # report only
+    python -m cloud.storage.fsck --store s3://bucket --workers 32 \\
+        --rate 500 --checkpoint fsck.ckpt --repair   # then repair
+
+createFile writes the file object before it adds the file to its
+directory, and deleteFile removes the entry before the object, so a
+crash or failed request in between leaves
+
+    orphan      a file object its directory does not list
+    dangling    a directory entry with no file object
+    segment     a directory segment its head does not route to, from a
+                split or segmentation cut short
+    usage       a "#usage" record of a home directory that is gone
+    history     the version history of a file that is gone
+
+which are repaired by deleting the object, segment or record, or
+dropping the entry; the usage records are corrected through the change
+listeners as for any other delete. Directories missing under files,
+segments missing from a head and keys with an unknown suffix are only
+reported, no interrupted write leaves them behind.
+
+The trees of ["home", user] are found with delimiter listings and
+listed and checked in parallel, a paginated listing each, against the
+directory objects read on the way. Files above the trees, such as
+those of the public ["logos"] directory, are seen in those delimiter
+listings and checked for orphans against the directory their key
+names. What is found is only a candidate:
+an upload may be between its two writes right now. A candidate is
+repaired once it is --grace seconds old and still the same, that is
+the object has the etag it was found with and the directory entry is
+as it was, which is checked again right before the repair.
+
+--rate caps the backend requests per second, a listing counting one
+request per page. With --checkpoint the position reached and the
+candidates found are saved every few seconds; rerunning the same
+command resumes from there, and a rerun with --repair after a report
+only run repairs what that run found without scanning again.
+
+Saves still in this process's write-behind journal are never taken
+for orphans; the app's own journal, kept in another process, only
+ever holds saves of files that are listed already.
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import (
+    ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait)
+
+from cloud.storage import codec, storage
+from cloud.storage.backends import NOT_MODIFIED, StorageBackend, StorageError
+from cloud.storage.migrate import Checkpoint, openBackend, unwrap
+
+# the trees checked one by one are those of paths this deep
+TREE_DEPTH = 2
+# keys per listing request, the S3 page size
+LIST_PAGE = 1000
+# issues that are repaired, and those only reported
+REPAIRABLE = ("orphan", "dangling", "segment", "usage", "history")
+REPORTED = ("missingDir", "missingSegment", "detached", "unknown")
+
+
+class RateLimiter:
+    """Spaces calls to wait() rate per second apart, 0 for no limit."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self, n=1):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next, now)
+            self.next = at + n * self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class RateLimitedBackend(StorageBackend):
+    """Wraps a backend, every request waiting its turn on limiter."""
+
+    def __init__(self, inner, limiter):
+        self.inner = inner
+        self.name = inner.name
+        self.limiter = limiter
+
+    # anything the wrapper does not handle, e.g. the S3 client
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        self.limiter.wait()
+        return self.inner.putItem(key, data, metadata, ifNoneMatch, ifMatch)
+
+    def getItem(self, key):
+        self.limiter.wait()
+        return self.inner.getItem(key)
+
+    def deleteItem(self, key):
+        self.limiter.wait()
+        return self.inner.deleteItem(key)
+
+    def getItemIfChanged(self, key, etag=None):
+        self.limiter.wait()
+        return self.inner.getItemIfChanged(key, etag)
+
+    def deleteItems(self, keys):
+        keys = list(keys)
+        self.limiter.wait(max(1, -(-len(keys) // LIST_PAGE)))
+        return self.inner.deleteItems(keys)
+
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        self.limiter.wait()
+        for i, key in enumerate(self.inner.listKeys(prefix, delimiter,
+                                                    startAfter), 1):
+            yield key
+            if i % LIST_PAGE == 0:
+                self.limiter.wait()
+
+    def openRead(self, key):
+        self.limiter.wait()
+        return self.inner.openRead(key)
+
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        self.limiter.wait()
+        return self.inner.openWrite(key, metadata, ifNoneMatch, ifMatch)
+
+
+# the listings that find the trees, in order: (prefix, delimiter,
+# levels of common prefixes down to a tree)
+def phases():
+    if storage.STORAGE_KEY_LAYOUT == "v2":
+        shards = 1 if storage.STORAGE_KEY_SHARDS > 0 else 0
+        found = [(storage.V2_PREFIX, "/", TREE_DEPTH + shards)]
+        if storage.STORAGE_KEY_FALLBACK:
+            found.append(('["', '", "', TREE_DEPTH))
+        return found
+    return [('["', '", "', TREE_DEPTH)]
+
+
+# the path of the tree a common prefix stands for
+def prefixToPath(prefix, delimiter):
+    if delimiter == "/":
+        return storage.keyToPath(prefix[:-1])[0]
+    # '["home", "a@b.c", "' -> ["home", "a@b.c"]
+    return json.loads(prefix[:-len(delimiter) + 1] + "]")
+
+
+def isSegment(suffix):
+    return suffix[1:].isdigit()
+
+
+# a file's "#history" record or one of its "#run<n>" version runs
+def isVersion(suffix):
+    return suffix == "#history" or \
+        (suffix.startswith("#run") and suffix[4:].isdigit())
+
+
+# whether filedata is a directory without any key below it, found only
+# as a name its parent does not list; every entry it has is dangling
+def isBareDir(filedata):
+    return filedata is not None and filedata["type"] == "dir" and \
+        not filedata.get("segmented")
+
+
+# the object at key as (plain data, etag, file object), None if missing
+def readObject(path, key):
+    data, etag, metadata = storage.backend.getItemIfChanged(key)
+    if data is None:
+        return None
+    plain = codec.decode(data)
+    return plain, etag, storage.itemToFile(path, plain, metadata or {})
+
+
+# whether the directory at path lists name now, and its entry
+def listedEntry(path, name):
+    head = storage.getFileRaw(path, revalidate=True)
+    if head is None or head["type"] != "dir":
+        return False, None
+    if head.get("segmented"):
+        segid = storage.segmentFor(head, name)
+        container = storage.readSegment(path, segid, revalidate=True)
+    else:
+        container = head
+    if name not in json.loads(container["data"]):
+        return False, None
+    return True, container.get("manifest", {}).get(name)
+
+
+class Fsck:
+    def __init__(self, args):
+        self.args = args
+        self.checkpoint = Checkpoint(args.checkpoint, {
+            "phase": 0, "after": None, "done": False, "trees": 0,
+            "keys": 0, "found": {}, "repaired": {}, "candidates": []})
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    # Scanning
+
+    def trees(self, prefix, delimiter, levels, after):
+        """Yield (common prefix, path) of every tree below prefix, in
+        listing order, past after; the keys above the trees are checked
+        on the way."""
+        start = after if after is not None and after.startswith(prefix) \
+            and levels == 1 else None
+        lastBase = None
+        files = {}      # directory path -> {name: key} of files listed here
+        subdirs = set()
+        for key in storage.backend.listKeys(prefix, delimiter, start):
+            if not key.endswith(delimiter):
+                if after is None or key > after:
+                    lastBase = self.checkTopKey(key, lastBase, files)
+                continue
+            subdirs.add(tuple(prefixToPath(key, delimiter)))
+            if after is not None and key <= after and not after.startswith(key):
+                continue
+            if levels > 1:
+                yield from self.trees(key, delimiter, levels - 1, after)
+            elif key != after:
+                yield key, prefixToPath(key, delimiter)
+        self.checkTopFiles(files, subdirs)
+
+    # keys above the trees: files and directories, whose parent is
+    # the directory the key names less its last element, added to files
+    # for checkTopFiles, and the usage records of home directories
+    def checkTopKey(self, key, lastBase, files):
+        path, suffix = storage.keyToPath(key)
+        if path is None or (suffix and suffix != "#usage"
+                            and not isSegment(suffix)
+                            and not isVersion(suffix)):
+            self.found("unknown", {"key": key})
+            return lastBase
+        if not suffix:
+            if len(path) > 1:
+                files.setdefault(tuple(path[:-1]), {})[path[-1]] = key
+            return key
+        if suffix != "#usage":
+            return lastBase
+        if len(path) != TREE_DEPTH or path[0] != "home":
+            self.found("unknown", {"key": key})
+        elif key[:-len(suffix)] != lastBase and \
+                storage.getFileRaw(path, revalidate=True) is None:
+            _, etag, _ = storage.backend.getItemIfChanged(key)
+            if etag is None:
+                return lastBase
+            self.found("usage", {"key": key, "path": path, "etag": etag})
+        return lastBase
+
+    def checkTopFiles(self, files, subdirs):
+        """Check {directory path: {name: key}} of the objects listed
+        above the trees against their directories, e.g. the public
+        ["logos"] directory. A listing may only hold part of a
+        directory, so only orphans are looked for."""
+        for dirpath, names in files.items():
+            # directories with a tree are not listed in their parent
+            names = {name: key for name, key in names.items()
+                     if dirpath + (name,) not in subdirs}
+            if not names:
+                continue
+            head = storage.getFileRaw(list(dirpath), revalidate=True)
+            if head is None or head["type"] != "dir":
+                kind = "missingDir" if head is None else "detached"
+                self.found(kind, {"path": list(dirpath), "children": len(names)})
+                continue
+            entries = dict(storage.iterDir(list(dirpath)))
+            for name in sorted(set(names) - set(entries)):
+                filedata = self.orphanCandidate(dirpath + (name,), names[name])
+                if isBareDir(filedata):
+                    self.checkDir(dirpath + (name,), set(), {}, {}, set())
+
+    def checkTree(self, root, skipNew):
+        """List and check the tree at root, returns the keys seen, or
+        None when the tree belongs to an earlier phase."""
+        if skipNew and self.hasCurrentKeys(root):
+            # checked with the current layout's trees
+            return None
+        objects = {}    # path -> keys, the current layout's first
+        segments = {}   # directory path -> {segid: key}
+        history = []    # (file path, key) of version records
+        keys = 0
+        listings = [storage.backend.listKeys(prefix)
+                    for prefix in storage.childPrefixes(root)]
+        listings += [storage.backend.listKeys(base + "#")
+                     for base in storage.objectKeys(root)]
+        for listing in listings:
+            for key in listing:
+                keys += 1
+                path, suffix = storage.keyToPath(key)
+                if path is None:
+                    self.found("unknown", {"key": key})
+                elif not suffix:
+                    objects.setdefault(tuple(path), []).append(key)
+                elif isSegment(suffix):
+                    segments.setdefault(tuple(path), {})[int(suffix[1:])] = key
+                elif isVersion(suffix):
+                    history.append((tuple(path), key))
+                elif suffix != "#usage" or tuple(path) != tuple(root):
+                    self.found("unknown", {"key": key})
+
+        children = {}
+        for path in objects:
+            if len(path) > len(root):
+                children.setdefault(path[:-1], set()).add(path[-1])
+        dirs = set(children) | set(segments) | {tuple(root)}
+        for dirpath in sorted(dirs):
+            self.checkDir(dirpath, children.get(dirpath, set()),
+                          segments.get(dirpath, {}), objects, dirs)
+        for path, key in history:
+            if path not in objects:
+                _, etag, _ = storage.backend.getItemIfChanged(key)
+                if etag is not None:
+                    self.found("history", {"key": key, "path": list(path),
+                                           "etag": etag})
+        return keys
+
+    # whether anything of the tree at root has a key of the current layout
+    def hasCurrentKeys(self, root):
+        base = storage.pathToString(root)
+        for key in storage.backend.listKeys(base, "/"):
+            if key == base or key == base + "/" or key.startswith(base + "#"):
+                return True
+            if key > base + "/":
+                return False
+        return False
+
+    def checkDir(self, dirpath, names, segkeys, objects, dirs):
+        path = list(dirpath)
+        head = storage.getFileRaw(path, revalidate=True)
+        if head is None or head["type"] != "dir":
+            if names:
+                kind = "missingDir" if head is None else "detached"
+                self.found(kind, {"path": path, "children": len(names)})
+            for segid, key in segkeys.items():
+                self.segmentCandidate(path, segid, key)
+            return
+        routed = set(int(i) for i in head["segments"]) \
+            if head.get("segmented") else set()
+        for segid in sorted(routed - set(segkeys)):
+            self.found("missingSegment", {"path": path, "segid": segid})
+        for segid, key in segkeys.items():
+            if segid not in routed:
+                self.segmentCandidate(path, segid, key)
+        entries = dict(storage.iterDir(path))
+
+        for name in sorted(names - set(entries)):
+            child = dirpath + (name,)
+            if child in dirs:
+                # subdirectories are not listed in their parent
+                continue
+            filedata = self.orphanCandidate(child, objects[child][0])
+            if isBareDir(filedata):
+                self.checkDir(child, set(), {}, objects, dirs)
+        for name in sorted(set(entries) - names):
+            if dirpath + (name,) in dirs:
+                continue
+            self.found("dangling", {"path": path + [name],
+                                    "entry": entries[name]})
+
+    # report the object at key, of the file at path, as an orphan
+    # unless it is a directory; returns its file object, None if gone
+    def orphanCandidate(self, path, key):
+        if storage.journal is not None and storage.journal.queued(key):
+            return None
+        found = readObject(list(path), key)
+        if found is None or found[2] is None:
+            return None
+        _, etag, filedata = found
+        if filedata["type"] != "dir":
+            self.found("orphan", {"key": key, "path": list(path), "etag": etag,
+                                  "size": storage.fileSize(filedata)})
+        return filedata
+
+    def segmentCandidate(self, path, segid, key):
+        _, etag, _ = storage.backend.getItemIfChanged(key)
+        if etag is not None:
+            self.found("segment", {"key": key, "path": path, "segid": segid,
+                                   "etag": etag})
+
+    def found(self, kind, issue):
+        issue = dict(issue, issue=kind)
+        print(json.dumps(issue))
+        state = self.checkpoint.state
+        with self.lock:
+            state["found"][kind] = state["found"].get(kind, 0) + 1
+            if kind in REPAIRABLE:
+                state["candidates"].append(dict(issue, seen=time.time()))
+
+    def attempt(self, root, skipNew):
+        try:
+            return root, self.checkTree(root, skipNew), None
+        except StorageError as e:
+            return root, None, e
+
+    def scan(self, pool):
+        state = self.checkpoint.state
+        workers = max(1, self.args.workers)
+        lastsave = time.monotonic()
+        if self.args.user:
+            roots = [["home", self.args.user]]
+            for root, keys, error in pool.map(
+                    lambda root: self.attempt(root, False), roots):
+                self.record(root, keys, error)
+            return
+        found = phases()
+        while state["phase"] < len(found):
+            prefix, delimiter, levels = found[state["phase"]]
+            skipNew = state["phase"] > 0
+            # trees of this phase in listing order, with done flags, so
+            # the checkpoint can advance past a contiguous run
+            order = deque()
+            done = {}
+            pending = {}
+            for position, root in self.trees(prefix, delimiter, levels,
+                                             state["after"]):
+                order.append(position)
+                pending[pool.submit(self.attempt, root, skipNew)] = position
+                full = len(pending) >= 4 * workers
+                pending = self.collect(pending, done,
+                                       FIRST_COMPLETED if full else None)
+                self.advance(order, done)
+                if time.monotonic() - lastsave > self.args.save_every:
+                    self.report()
+                    self.checkpoint.save()
+                    lastsave = time.monotonic()
+            self.collect(pending, done, ALL_COMPLETED)
+            self.advance(order, done)
+            state["phase"] += 1
+            state["after"] = None
+            self.checkpoint.save()
+
+    # until None only collects the checks already done
+    def collect(self, pending, done, until):
+        if until is None:
+            finished, rest = wait(pending, timeout=0)
+        else:
+            finished, rest = wait(pending, return_when=until)
+        for future in finished:
+            root, keys, error = future.result()
+            self.record(root, keys, error)
+            done[pending[future]] = True
+        return {f: pending[f] for f in rest}
+
+    def advance(self, order, done):
+        # move the watermark over the done prefix of order; a tree that
+        # failed is not done and stops it, so a rerun checks it again
+        state = self.checkpoint.state
+        while order and done.pop(order[0], False):
+            state["after"] = order.popleft()
+
+    def record(self, root, keys, error):
+        state = self.checkpoint.state
+        with self.lock:
+            if error is not None:
+                print(f"check failed: {root}: {error}")
+                state["failedTrees"] = state.get("failedTrees", 0) + 1
+            elif keys is not None:
+                state["trees"] += 1
+                state["keys"] += keys
+
+    # Repairing
+
+    def repair(self, issue):
+        """Repair one candidate if it is still what was found, returns
+        True when repaired. Raises StorageError."""
+        wait = issue["seen"] + self.args.grace - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        kind = issue["issue"]
+        if kind == "orphan":
+            path = issue["path"]
+            listed, _ = listedEntry(path[:-1], path[-1])
+            if listed or not self.unchanged(issue):
+                return False
+            if not storage.deleteItem(storage.pathToString(path)):
+                raise StorageError(f"delete {issue['key']} failed")
+            storage.notifyChanges([(path, issue["size"], None)])
+            return True
+        if kind == "dangling":
+            path = issue["path"]
+            listed, entry = listedEntry(path[:-1], path[-1])
+            if not listed or entry != issue["entry"] or any(
+                    storage.backend.getItemIfChanged(key)[0] is not None
+                    for key in storage.objectKeys(path)):
+                return False
+            removed = []
+
+            # keep an entry a create put back in the meantime
+            def drop(previous):
+                if previous != issue["entry"]:
+                    return previous
+                removed.append(path)
+                return None
+            if not storage.updateDirEntries(path[:-1], {path[-1]: drop}):
+                raise StorageError(f"update {path[:-1]} failed")
+            if removed:
+                size = (issue["entry"] or {}).get("size", 0)
+                storage.notifyChanges([(path, size, None)])
+            return bool(removed)
+        if kind == "segment":
+            head = storage.getFileRaw(issue["path"], revalidate=True)
+            if head is not None and head["type"] == "dir" and \
+                    head.get("segmented") and \
+                    str(issue["segid"]) in head["segments"]:
+                return False
+        elif kind in ("usage", "history"):
+            if storage.getFileRaw(issue["path"], revalidate=True) is not None:
+                return False
+        if not self.unchanged(issue):
+            return False
+        if not storage.deleteItems([issue["key"]]):
+            raise StorageError(f"delete {issue['key']} failed")
+        return True
+
+    def unchanged(self, issue):
+        data, _, _ = storage.backend.getItemIfChanged(issue["key"],
+                                                      issue["etag"])
+        return data is NOT_MODIFIED
+
+    def attemptRepair(self, issue):
+        try:
+            return issue, self.repair(issue), None
+        except StorageError as e:
+            return issue, False, e
+
+    def repairAll(self, pool):
+        state = self.checkpoint.state
+        candidates = sorted(state["candidates"], key=lambda i: i["seen"])
+        kept = []
+        for issue, repaired, error in pool.map(self.attemptRepair, candidates):
+            kind = issue["issue"]
+            if error is not None:
+                print(f"repair failed: {kind} {issue.get('key') or issue['path']}: {error}")
+                kept.append(issue)
+            elif repaired:
+                with self.lock:
+                    state["repaired"][kind] = state["repaired"].get(kind, 0) + 1
+            else:
+                state["skipped"] = state.get("skipped", 0) + 1
+        state["candidates"] = kept
+        self.checkpoint.save()
+
+    def run(self):
+        state = self.checkpoint.state
+        with ThreadPoolExecutor(max_workers=max(1, self.args.workers),
+                                thread_name_prefix="fsck") as pool:
+            if not state["done"]:
+                self.scan(pool)
+                state["done"] = not state.get("failedTrees")
+                self.checkpoint.save()
+            if self.args.repair:
+                self.repairAll(pool)
+        self.report()
+        return state["done"] and not state["candidates"] and not any(
+            state["found"].get(kind) for kind in REPORTED)
+
+    def report(self):
+        state = self.checkpoint.state
+        elapsed = time.monotonic() - self.started
+        print(json.dumps({
+            "trees": state["trees"],
+            "keys": state["keys"],
+            "found": state["found"],
+            "candidates": len(state["candidates"]),
+            "repaired": state["repaired"],
+            "skipped": state.get("skipped", 0),
+            "failedTrees": state.get("failedTrees", 0),
+            "after": state["after"],
+            "keysPerSecond": round(state["keys"] / elapsed, 1) if elapsed else None,
+        }))
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m cloud.storage.fsck",
+        description="Find and repair orphan objects and dangling "
+                    "directory entries left by interrupted writes.")
+    parser.add_argument("--store", help="s3://bucket, local:/dir or sqlite:/file")
+    parser.add_argument("--user", help="only check the tree of this user")
+    parser.add_argument("--repair", action="store_true",
+                        help="repair what is found, otherwise only report it")
+    parser.add_argument("--grace", type=float, default=300.0,
+                        help="seconds a candidate must stay unchanged before "
+                             "it is repaired")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="backend requests per second, 0 for no limit")
+    parser.add_argument("--checkpoint", help="file to save progress to and resume from")
+    parser.add_argument("--save-every", type=float, default=5.0,
+                        help="seconds between checkpoint saves")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    # setBackend adds the retries above the rate limit
+    storage.setBackend(RateLimitedBackend(unwrap(openBackend(args.store)),
+                                          RateLimiter(args.rate)))
+    return 0 if Fsck(args).run() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
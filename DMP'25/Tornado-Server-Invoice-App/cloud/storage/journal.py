@@ -0,0 +1,362 @@
+"""
+Storage Save Journal
+
+Write-behind journal for file saves. A save is appended to a local
+journal and fsync'd, which is all the caller waits for; a background
+thread then writes the latest save of every path to the backend,
+so a burst of saves of one sheet costs one backend write.
+
+The journal is a directory of segment files named by the sequence
+number of their first record. A record is
+
+    length (4 bytes) | crc32 (4 bytes) | json payload
+
+the payload being {"seq": n, "key": key, "path": path, "data": data}
+for a save, or {"seq": n, "key": key, "drop": true} when a save still
+in the journal must not be applied again (see supersede). Appends are
+group committed: concurrent appends share one fsync. The oldest
+segments are deleted once every save in them has been written or
+replaced by a later one.
+
+On startup the segments are replayed, in order, up to the first torn
+or corrupt record, and the saves found are queued for writing again;
+writing a save twice is harmless. Reads of a path with a save queued
+see the save (lookup), and any other write or delete of such a path
+goes through supersede first, so the queued save never lands on top
+of a newer value.
+
+One journal directory belongs to one process, it is locked while open.
+"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+
+from cloud.storage.backends import StorageError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HEADER = struct.Struct(">II")
+SUFFIX = ".journal"
+# longest wait between attempts when the backend keeps failing
+MAX_BACKOFF = 30.0
+
+
+class Entry:
+    __slots__ = ("seq", "key", "path", "data", "body")
+
+    def __init__(self, seq, key, path, data):
+        self.seq = seq
+        self.key = key
+        self.path = path
+        self.data = data
+        # the stored form, as upsertFile writes it
+        self.body = json.dumps(
+            {"data": data, "path": path, "type": "file"}).encode('utf-8')
+
+
+class Segment:
+    __slots__ = ("name", "first", "last", "size")
+
+    def __init__(self, name, first):
+        self.name = name
+        self.first = first
+        self.last = None
+        self.size = 0
+
+
+class Journal:
+    def __init__(self, root, write, delay=1.0, segmentBytes=16 * 1024 * 1024):
+        """write(path, data) stores one save, returning True/False."""
+        self.root = os.path.abspath(root)
+        self.write = write
+        self.delay = delay
+        self.segmentBytes = segmentBytes
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.syncLock = threading.Lock()
+        self.local = threading.local()
+        self.pending = {}    # key -> Entry not written yet
+        self.inflight = {}   # key -> Entry being written
+        self.live = {}       # key -> seq of its last record in a segment
+        self.segments = []
+        self.seq = 0
+        # bytes appended and bytes known to be on disk, over all segments
+        self.written = 0
+        self.synced = 0
+        self.fd = None
+        self.stopping = threading.Event()
+        self.counters = {"appended": 0, "replaced": 0, "flushed": 0,
+                         "failures": 0, "replayed": 0}
+        os.makedirs(self.root, exist_ok=True)
+        self.lockFile = open(os.path.join(self.root, "lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.lockFile.close()
+                raise OSError(f"journal {self.root} is in use by another process")
+        self.replay()
+        self.openSegment()
+        self.flusher = threading.Thread(target=self.run, name="journal",
+                                        daemon=True)
+        self.flusher.start()
+
+    # Segments
+
+    def segmentFiles(self):
+        names = [n for n in os.listdir(self.root) if n.endswith(SUFFIX)]
+        return sorted(names, key=lambda n: int(n[:-len(SUFFIX)]))
+
+    def replay(self):
+        for name in self.segmentFiles():
+            fname = os.path.join(self.root, name)
+            segment = Segment(name, int(name[:-len(SUFFIX)]))
+            with open(fname, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                length, crc = HEADER.unpack_from(data, offset)
+                payload = data[offset + HEADER.size:offset + HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                try:
+                    record = json.loads(payload)
+                except ValueError:
+                    break
+                offset += HEADER.size + length
+                entry = None if record.get("drop") else Entry(
+                    record["seq"], record["key"], record["path"], record["data"])
+                self.apply(record, entry)
+                segment.last = record["seq"]
+            if offset < len(data):
+                # a torn append; nothing after it was acknowledged
+                print(f"journal {name}: ignoring {len(data) - offset} bytes "
+                      f"after offset {offset}")
+                with open(fname, "r+b") as f:
+                    f.truncate(offset)
+            segment.size = offset
+            if segment.last is None:
+                os.remove(fname)
+                continue
+            self.segments.append(segment)
+        self.counters["replayed"] = len(self.pending)
+        if self.pending:
+            print(f"journal: {len(self.pending)} saves to write after restart")
+
+    # the effect of a record on what is queued, the same on replay as
+    # when it is appended
+    def apply(self, record, entry):
+        key = record["key"]
+        self.seq = max(self.seq, record["seq"] + 1)
+        self.live[key] = record["seq"]
+        if record.get("drop"):
+            self.pending.pop(key, None)
+        else:
+            if key in self.pending:
+                self.counters["replaced"] += 1
+            self.pending[key] = entry
+
+    # called holding syncLock and lock, or before the flusher started
+    def openSegment(self):
+        if self.fd is not None:
+            if self.synced < self.written:
+                os.fsync(self.fd)
+                self.synced = self.written
+            os.close(self.fd)
+        segment = Segment(f"{self.seq:016d}{SUFFIX}", self.seq)
+        self.fd = os.open(os.path.join(self.root, segment.name),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.segments.append(segment)
+        if hasattr(os, "O_DIRECTORY"):
+            # make the new file itself durable
+            dirfd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+    def record(self, record, entry=None):
+        """Append a record and apply it, entry being the save it
+        queues; durable on return. Raises OSError."""
+        # serialized outside the lock, the seq is spliced in under it
+        rest = json.dumps(record).encode('utf-8')[1:]
+        with self.cond:
+            seq = record["seq"] = self.seq
+            payload = b'{"seq": %d, ' % seq + rest
+            os.write(self.fd, HEADER.pack(len(payload), zlib.crc32(payload))
+                     + payload)
+            if entry is not None:
+                entry.seq = seq
+            self.apply(record, entry)
+            segment = self.segments[-1]
+            segment.last = seq
+            segment.size += HEADER.size + len(payload)
+            self.written += HEADER.size + len(payload)
+            position = self.written
+            roll = segment.size >= self.segmentBytes
+            self.cond.notify_all()
+        self.sync(position)
+        if roll:
+            with self.syncLock, self.lock:
+                if self.segments[-1] is segment:
+                    self.openSegment()
+
+    def sync(self, position):
+        # group commit: whoever gets the lock first syncs for everyone
+        # who appended before it
+        with self.syncLock:
+            if self.synced >= position:
+                return
+            with self.lock:
+                target = self.written
+                fd = self.fd
+            os.fsync(fd)
+            self.synced = target
+
+    # delete the segments holding nothing that is still to be written
+    def collect(self):
+        removed = []
+        with self.syncLock, self.lock:
+            queued = list(self.pending.values()) + list(self.inflight.values())
+            oldest = min((e.seq for e in queued), default=self.seq)
+            current = self.segments[-1]
+            if current.last is not None and current.last < oldest:
+                self.openSegment()
+            while len(self.segments) > 1 and (self.segments[0].last is None
+                                              or self.segments[0].last < oldest):
+                removed.append(self.segments.pop(0))
+            if removed:
+                last = max(s.last for s in removed if s.last is not None)
+                self.live = {k: s for k, s in self.live.items() if s > last}
+        for segment in removed:
+            try:
+                os.remove(os.path.join(self.root, segment.name))
+            except OSError as e:
+                print(f"Error removing journal segment: {e}")
+
+    # Saves
+
+    def append(self, key, path, data):
+        """Journal a save of data at path, key being its storage key.
+        Durable on return; raises OSError."""
+        self.record({"key": key, "path": path, "data": data},
+                    Entry(None, key, path, data))
+        with self.lock:
+            self.counters["appended"] += 1
+
+    def queued(self, key):
+        with self.lock:
+            return key in self.pending or key in self.inflight
+
+    def lookup(self, key):
+        """The stored form of the save queued for key, or None."""
+        if getattr(self.local, "flushing", False):
+            return None
+        with self.lock:
+            entry = self.pending.get(key) or self.inflight.get(key)
+        return entry.body if entry is not None else None
+
+    def supersede(self, key):
+        """Called before key is written or deleted by other means. A
+        queued save of key is written first, even ahead of a delete, so
+        that the caller finds stored what it may have read, and a
+        journaled save of key is kept from being replayed.
+        Raises StorageError."""
+        if getattr(self.local, "flushing", False):
+            return
+        with self.cond:
+            if key not in self.live:
+                return
+            while key in self.inflight:
+                self.cond.wait()
+            entry = self.pending.pop(key, None)
+            if entry is not None:
+                self.inflight[key] = entry
+        if entry is not None:
+            ok = self.store(entry)
+            with self.cond:
+                del self.inflight[key]
+                if not ok and key not in self.pending:
+                    self.pending[key] = entry
+                self.cond.notify_all()
+            if not ok:
+                raise StorageError(f"journal: could not write {key}")
+        try:
+            self.record({"key": key, "drop": True})
+        except OSError as e:
+            raise StorageError(f"journal: {e}") from e
+
+    def store(self, entry):
+        self.local.flushing = True
+        try:
+            ok = self.write(entry.path, entry.data)
+        except Exception as e:
+            print(f"Error writing journaled save: {e}")
+            ok = False
+        finally:
+            self.local.flushing = False
+        with self.lock:
+            self.counters["flushed" if ok else "failures"] += 1
+        return ok
+
+    def flush(self):
+        """Write every queued save now, returns True when all were."""
+        with self.cond:
+            entries = list(self.pending.values())
+            self.pending.clear()
+            self.inflight.update((e.key, e) for e in entries)
+        ok = True
+        for entry in entries:
+            stored = self.store(entry)
+            ok = ok and stored
+            with self.cond:
+                del self.inflight[entry.key]
+                # a newer save or a supersede may have come in meanwhile
+                if not stored and entry.key not in self.pending:
+                    self.pending[entry.key] = entry
+                self.cond.notify_all()
+        self.collect()
+        return ok
+
+    def run(self):
+        backoff = self.delay
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping.is_set():
+                    self.cond.wait()
+            # let a burst of saves collapse into one write
+            if self.stopping.wait(self.delay):
+                return
+            if self.flush():
+                backoff = self.delay
+            elif self.stopping.wait(backoff):
+                return
+            else:
+                backoff = min(MAX_BACKOFF, backoff * 2)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=len(self.pending),
+                        inflight=len(self.inflight),
+                        segments=len(self.segments))
+
+    def close(self):
+        """Stop the flusher after writing what it can; whatever is
+        left is replayed on the next start."""
+        self.stopping.set()
+        with self.cond:
+            self.cond.notify_all()
+        self.flusher.join()
+        self.flush()
+        with self.syncLock, self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+        self.lockFile.close()
@@ -0,0 +1,441 @@
+"""
+Storage Metrics
+
+Latency histograms and counters for the storage primitives and the
+backend calls below them, labelled with the request that made them.
+
+Every measured call is a Span. Storage primitives (getItem, putItem,
+createFile, ...) open one with span() or the timed() decorator, and
+MeteredBackend opens one per backend call, named after the backend,
+e.g. "s3.getItem", so each S3 request is seen on its own and retries
+and hedges count once per attempt. A span records its latency, an
+error when the call failed, the bytes it read and wrote, and item reads
+served from a cache (hits) or fetched from the backend (misses).
+Spans of primitives include the bytes, hits and misses of the
+primitives they call, so getFile counts the read of its item.
+
+A Trace names the unit of work a span belongs to, a tornado handler
+in the app: startTrace sets it for the current context, and spans
+opened there, or on TracedExecutor threads the work was handed to,
+are recorded under its name and kept on it. Hooks added with addHook
+see every finished span, e.g. to forward them to a tracing system.
+
+The registry is exposed in the Prometheus text format by prometheus()
+and as a dict by snapshot(). Configured from the environment:
+
+    STORAGE_METRICS          - false turns all of it off
+    STORAGE_TRACE_SLOW_MS    - report traces spending longer than this
+                               in storage, 0 for never
+"""
+
+import os
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from cloud.storage.backends import PreconditionFailed, StorageBackend
+
+STORAGE_METRICS = os.getenv("STORAGE_METRICS", "true").lower() in ("1", "true", "yes")
+STORAGE_TRACE_SLOW_MS = float(os.getenv("STORAGE_TRACE_SLOW_MS", "0"))
+
+# histogram bucket bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+# spans kept on one trace, later ones are only counted
+TRACE_SPANS = 256
+
+_trace = contextvars.ContextVar("storage_trace", default=None)
+_span = contextvars.ContextVar("storage_span", default=None)
+# guards the counters of spans, children may finish on other threads
+_lock = threading.Lock()
+
+hooks = []
+
+
+def addHook(hook):
+    """hook(span) is called for every finished span, in the thread
+    that ran it."""
+    hooks.append(hook)
+
+
+def removeHook(hook):
+    hooks.remove(hook)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.spans = []
+        self.count = 0
+        # seconds spent in spans that have no parent span
+        self.seconds = 0.0
+
+    def add(self, span):
+        with _lock:
+            self.count += 1
+            if len(self.spans) < TRACE_SPANS:
+                self.spans.append(span)
+            if span.parent is None:
+                self.seconds += span.seconds
+
+    def summary(self):
+        """One line naming the slowest top level spans."""
+        top = sorted((s for s in self.spans if s.parent is None),
+                     key=lambda s: s.seconds, reverse=True)[:5]
+        calls = ", ".join(f"{s.op} {s.seconds * 1000:.1f}ms" for s in top)
+        return (f"{self.name}: {self.count} storage calls, "
+                f"{self.seconds * 1000:.1f}ms: {calls}")
+
+
+def startTrace(name):
+    """Start a trace for the current context, returns it."""
+    trace = Trace(name)
+    trace.token = _trace.set(trace)
+    return trace
+
+
+def endTrace(trace):
+    """End a trace started in this context, reporting it when slow."""
+    try:
+        _trace.reset(trace.token)
+    except ValueError:
+        # ended from another context, nothing to restore
+        pass
+    if STORAGE_TRACE_SLOW_MS and trace.seconds * 1000 >= STORAGE_TRACE_SLOW_MS:
+        print(f"Slow storage: {trace.summary()}")
+
+
+def currentTrace():
+    return _trace.get()
+
+
+class Span:
+    __slots__ = ("op", "key", "layer", "trace", "parent", "started",
+                 "seconds", "error", "hits", "misses", "bytesIn",
+                 "bytesOut", "token")
+
+    def __init__(self, op, key=None, layer="op"):
+        self.op = op
+        self.key = key
+        self.layer = layer
+        self.trace = _trace.get()
+        self.parent = _span.get()
+        self.seconds = 0.0
+        self.error = None
+        self.hits = 0
+        self.misses = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def __enter__(self):
+        self.token = _span.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, e, tb):
+        self.seconds = time.perf_counter() - self.started
+        _span.reset(self.token)
+        # a failed condition is an answer, not an error
+        if e is not None and not isinstance(e, PreconditionFailed):
+            self.fail(e)
+        finish(self)
+        return False
+
+    def fail(self, error=True):
+        self.error = error
+
+    def hit(self, n=1):
+        self.hits += n
+
+    def miss(self, n=1):
+        self.misses += n
+
+    def received(self, n):
+        self.bytesIn += n
+
+    def sent(self, n):
+        self.bytesOut += n
+
+
+class NoSpan:
+    """Stands in for a span while metrics are off, or outside of any."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, e, tb):
+        return False
+
+    def fail(self, error=True):
+        pass
+
+    def hit(self, n=1):
+        pass
+
+    def miss(self, n=1):
+        pass
+
+    def received(self, n):
+        pass
+
+    def sent(self, n):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(op, key=None, layer="op"):
+    """A span to run a call in: with span("getItem", key) as s: ..."""
+    if not STORAGE_METRICS:
+        return NO_SPAN
+    return Span(op, key, layer)
+
+
+def current():
+    """The innermost open span of this context."""
+    return _span.get() or NO_SPAN
+
+
+def timed(op, failed=lambda result: result is False):
+    """Decorator running every call of fn in a span named op, keyed by
+    its first argument. A call fails when it raises, or when failed(its
+    result) is true, by default when it returns False."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            if not STORAGE_METRICS:
+                return fn(*args, **kwargs)
+            with Span(op, args[0] if args else None) as s:
+                result = fn(*args, **kwargs)
+                if failed(result):
+                    s.fail()
+                return result
+        return run
+    return wrap
+
+
+def finish(span):
+    parent = span.parent
+    # primitives count what the primitives they call did
+    if span.layer == "op" and parent is not None and parent.layer == "op":
+        with _lock:
+            parent.hits += span.hits
+            parent.misses += span.misses
+            parent.bytesIn += span.bytesIn
+            parent.bytesOut += span.bytesOut
+    registry.record(span)
+    if span.trace is not None:
+        span.trace.add(span)
+    for hook in list(hooks):
+        try:
+            hook(span)
+        except Exception as e:
+            print(f"Error in metrics hook: {e}")
+
+
+class OpStats:
+    __slots__ = ("buckets", "sum", "count", "errors", "hits", "misses",
+                 "bytesIn", "bytesOut")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th call, in seconds."""
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    def __init__(self):
+        # (op, trace name) -> OpStats
+        self.ops = {}
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        label = (span.op, span.trace.name if span.trace is not None else "")
+        with self.lock:
+            stats = self.ops.get(label)
+            if stats is None:
+                stats = self.ops[label] = OpStats()
+            stats.buckets[bisect.bisect_left(BUCKETS, span.seconds)] += 1
+            stats.sum += span.seconds
+            stats.count += 1
+            if span.error is not None:
+                stats.errors += 1
+            stats.hits += span.hits
+            stats.misses += span.misses
+            stats.bytesIn += span.bytesIn
+            stats.bytesOut += span.bytesOut
+
+    def clear(self):
+        with self.lock:
+            self.ops.clear()
+
+    def snapshot(self):
+        """{op: {handler: counters}}, times in milliseconds."""
+        result = {}
+        with self.lock:
+            for (op, handler), stats in sorted(self.ops.items()):
+                p50, p99 = stats.percentile(0.5), stats.percentile(0.99)
+                result.setdefault(op, {})[handler] = {
+                    "calls": stats.count,
+                    "errors": stats.errors,
+                    "hits": stats.hits,
+                    "misses": stats.misses,
+                    "bytesIn": stats.bytesIn,
+                    "bytesOut": stats.bytesOut,
+                    "totalMs": round(stats.sum * 1000, 2),
+                    "p50Ms": None if p50 is None else p50 * 1000,
+                    "p99Ms": None if p99 is None else p99 * 1000,
+                }
+        return result
+
+    def prometheus(self):
+        """The registry in the Prometheus text exposition format."""
+        with self.lock:
+            items = sorted(self.ops.items())
+            rows = [(op, handler, list(s.buckets), s.sum, s.count,
+                     s.errors, s.hits, s.misses, s.bytesIn, s.bytesOut)
+                    for (op, handler), s in items]
+        lines = ["# HELP storage_op_seconds Latency of storage calls.",
+                 "# TYPE storage_op_seconds histogram"]
+        for op, handler, buckets, total, count, *_ in rows:
+            labels = f'op="{escape(op)}",handler="{escape(handler)}"'
+            seen = 0
+            for bound, n in zip(BUCKETS + (None,), buckets):
+                seen += n
+                le = "+Inf" if bound is None else repr(bound)
+                lines.append(f'storage_op_seconds_bucket{{{labels},le="{le}"}} {seen}')
+            lines.append(f"storage_op_seconds_sum{{{labels}}} {total!r}")
+            lines.append(f"storage_op_seconds_count{{{labels}}} {count}")
+        counters = (
+            ("errors", 5, "Storage calls that failed."),
+            ("cache_hits", 6, "Item reads served from a cache."),
+            ("cache_misses", 7, "Item reads fetched from the backend."),
+            ("read_bytes", 8, "Bytes read by storage calls."),
+            ("written_bytes", 9, "Bytes written by storage calls."),
+        )
+        for name, column, help in counters:
+            lines.append(f"# HELP storage_op_{name}_total {help}")
+            lines.append(f"# TYPE storage_op_{name}_total counter")
+            for row in rows:
+                labels = f'op="{escape(row[0])}",handler="{escape(row[1])}"'
+                lines.append(f"storage_op_{name}_total{{{labels}}} {row[column]}")
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+class TracedExecutor(ThreadPoolExecutor):
+    """A thread pool running each task in a copy of the submitter's
+    context, so that spans opened by the task join the submitter's
+    trace and nest under its current span."""
+
+    def submit(self, fn, *args, **kwargs):
+        context = contextvars.copy_context()
+        return super().submit(context.run, fn, *args, **kwargs)
+
+
+def valueSize(data):
+    return len(data) if isinstance(data, (bytes, bytearray, str)) else 0
+
+
+class MeteredBackend(StorageBackend):
+    """Wraps a backend, running every call in a span named
+    "<backend name>.<method>"."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+
+    # anything the wrapper does not handle, e.g. the S3 client
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        with span(f"{self.name}.putItem", key, "backend") as s:
+            s.sent(valueSize(data))
+            return self.inner.putItem(key, data, metadata, ifNoneMatch,
+                                      ifMatch)
+
+    def getItem(self, key):
+        with span(f"{self.name}.getItem", key, "backend") as s:
+            data = self.inner.getItem(key)
+            s.received(valueSize(data))
+            return data
+
+    def deleteItem(self, key):
+        with span(f"{self.name}.deleteItem", key, "backend"):
+            return self.inner.deleteItem(key)
+
+    def getItemIfChanged(self, key, etag=None):
+        with span(f"{self.name}.getItemIfChanged", key, "backend") as s:
+            result = self.inner.getItemIfChanged(key, etag)
+            s.received(valueSize(result[0]))
+            return result
+
+    # a listing is one span, timing only the fetching of its pages and
+    # not the caller's work in between
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        keys = self.inner.listKeys(prefix, delimiter, startAfter)
+        if not STORAGE_METRICS:
+            return keys
+        return self.meteredListing(iter(keys), prefix)
+
+    def meteredListing(self, keys, prefix):
+        s = Span(f"{self.name}.listKeys", prefix, "backend")
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    key = next(keys)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    s.fail(e)
+                    raise
+                finally:
+                    s.seconds += time.perf_counter() - started
+                yield key
+        finally:
+            finish(s)
+
+    def deleteItems(self, keys):
+        keys = list(keys)
+        with span(f"{self.name}.deleteItems", keys[0] if keys else None,
+                  "backend"):
+            return self.inner.deleteItems(keys)
+
+    # only opening is measured, the stream is read by the caller
+    def openRead(self, key):
+        with span(f"{self.name}.openRead", key, "backend"):
+            return self.inner.openRead(key)
+
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        return self.inner.openWrite(key, metadata, ifNoneMatch, ifMatch)
@@ -0,0 +1,350 @@
+"""
+Storage Migration
+
+Copies a tree of storage objects to another backend, bucket, key
+layout or blob format:
+
+    python -m cloud.storage.migrate --source s3://old-bucket \\
+        --dest s3://new-bucket --to-layout v2 --to-shards 16 \\
+        --blobs raw --workers 64 --checkpoint migrate.ckpt --verify
+
+Backends are given as s3://bucket, local:/dir or sqlite:/file.db, and
+default to the one configured by the environment. Keys are enumerated
+with backend listings in sorted order and copied on a pool of workers,
+with S3 server side copy when both ends are S3 and the object does not
+need converting. --blobs raw turns legacy base64 upload envelopes into
+raw blobs, --blobs envelope does the reverse. Converted objects are
+compressed as STORAGE_COMPRESSION says for the destination backend,
+all others are copied byte for byte, compressed or not.
+
+Migrating within one store (same --source and --dest) only creates
+keys that do not exist yet, so objects the running app already rewrote
+in the new layout are kept; --move also deletes each source key once
+it is copied.
+
+With --checkpoint the position reached is saved every few seconds: the
+highest key below which every key is done, plus the keys that failed.
+Rerunning the same command resumes from there and retries the failed
+keys first. --verify reads every copied object back and compares its
+sha256, or its etag for server side copies.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import (
+    ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait)
+
+from cloud.storage import codec, storage, resilience
+from cloud.storage.backends import (
+    NOT_MODIFIED, LocalBackend, PreconditionFailed, S3Backend, SQLiteBackend,
+    StorageError, createBackend)
+
+
+def openBackend(spec):
+    """Backend for s3://bucket, local:/dir or sqlite:/file, or the
+    environment's when spec is None; wrapped for retries."""
+    if spec is None:
+        backend = createBackend()
+    elif spec.startswith("s3://"):
+        backend = S3Backend(spec[len("s3://"):])
+    elif spec.startswith("local:"):
+        backend = LocalBackend(spec[len("local:"):])
+    elif spec.startswith("sqlite:"):
+        backend = SQLiteBackend(spec[len("sqlite:"):])
+    else:
+        raise ValueError(f"Unknown backend: {spec}")
+    return resilience.fromEnv(backend)
+
+
+def unwrap(backend):
+    return getattr(backend, "inner", backend)
+
+
+class Checkpoint:
+    def __init__(self, fname, state=None):
+        self.fname = fname
+        self.state = state if state is not None else {
+            "phase": 0, "after": None, "failed": [], "copied": 0, "bytes": 0}
+        if fname and os.path.exists(fname):
+            with open(fname) as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        if not self.fname:
+            return
+        tmpname = self.fname + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self.fname)
+
+
+class Migration:
+    def __init__(self, source, dest, args):
+        self.source = source
+        self.dest = dest
+        self.args = args
+        self.inPlace = args.source == args.dest
+        self.serverCopy = args.blobs == "keep" and not self.inPlace and \
+            isinstance(unwrap(source), S3Backend) and \
+            isinstance(unwrap(dest), S3Backend)
+        # converted values are compressed as the destination would be
+        self.compression = codec.fromEnv(unwrap(dest).name)
+        self.checkpoint = Checkpoint(args.checkpoint)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.verified = 0
+        self.mismatched = 0
+
+    # the listings to walk, in order: (prefix, delimiter, key filter)
+    def phases(self):
+        path = self.args.path
+        if not path:
+            return [("", None, None)]
+        base = storage.layoutKey(path, self.args.from_layout, self.args.from_shards)
+        # the object itself and its segments, not its children
+        phases = [(base, "/",
+                   lambda key: key == base or key.startswith(base + "#"))]
+        for prefix in storage.layoutPrefixes(path, self.args.from_layout,
+                                             self.args.from_shards):
+            phases.append((prefix, None, None))
+        return phases
+
+    def mapKey(self, key):
+        path, suffix = storage.keyToPath(key, self.args.from_shards)
+        if path is None:
+            return key
+        return storage.layoutKey(path, self.args.to_layout,
+                                 self.args.to_shards) + suffix
+
+    def convert(self, key, data, metadata):
+        """Apply --blobs, returns (data, metadata)."""
+        metadata = metadata or {}
+        if self.args.blobs == "raw" and metadata.get("type") != "blob":
+            try:
+                filedata = json.loads(data)
+            except ValueError:
+                return data, metadata
+            if not isinstance(filedata, dict) or filedata.get("type") != "file":
+                return data, metadata
+            content, meta = storage.decodeEnvelope(filedata["data"])
+            if meta is None:
+                return data, metadata
+            if meta.get("encoding") == "base64":
+                meta = {k: v for k, v in meta.items() if k != "encoding"}
+            return content, storage.blobMetadata(meta)
+        if self.args.blobs == "envelope" and metadata.get("type") == "blob":
+            path, _ = storage.keyToPath(key, self.args.from_shards)
+            meta = dict(json.loads(metadata.get("meta") or "{}"),
+                        encoding="base64")
+            envelope = {"metadata": meta,
+                        "content": base64.b64encode(data).decode('utf-8')}
+            body = json.dumps({"data": json.dumps(envelope), "path": path,
+                               "type": "file"})
+            return body.encode('utf-8'), {}
+        return data, metadata
+
+    def copyKey(self, key):
+        """Copy one key, returns the bytes copied, None if it vanished.
+        Raises StorageError, or ValueError when verification fails."""
+        if self.inPlace and self.args.from_layout == "json" and \
+                key.startswith(storage.V2_PREFIX):
+            # written by the app in the new layout already
+            return None
+        newkey = self.mapKey(key)
+        # converting in place replaces the key itself
+        replace = self.inPlace and newkey == key
+        if replace and self.args.blobs == "keep":
+            return None
+        if self.serverCopy:
+            src = unwrap(self.source)
+            etag = unwrap(self.dest).copyItem(src.bucket, key, newkey)
+            if self.args.verify:
+                data, _, _ = self.source.getItemIfChanged(key, etag)
+                if data is not NOT_MODIFIED:
+                    raise ValueError(f"etag mismatch for {newkey}")
+                self.countVerified()
+            self.moved(key)
+            return 0
+
+        data, etag, metadata = self.source.getItemIfChanged(key)
+        if data is None:
+            return None
+        if self.args.blobs != "keep":
+            plain = codec.decode(data)
+            converted, metadata = self.convert(key, plain, metadata)
+            if converted is not plain:
+                data = self.compression.encode(converted)
+            elif replace:
+                return None
+        try:
+            # in place, never overwrite what the app wrote meanwhile
+            self.dest.putItem(newkey, data, metadata or None,
+                              ifNoneMatch=self.inPlace and not replace,
+                              ifMatch=etag if replace else None)
+        except PreconditionFailed:
+            if not replace:
+                self.moved(key)
+            return None
+        if self.args.verify:
+            copied, _, copiedmeta = self.dest.getItemIfChanged(newkey)
+            if copied is None or \
+                    hashlib.sha256(copied).digest() != hashlib.sha256(data).digest() \
+                    or (copiedmeta or {}) != (metadata or {}):
+                raise ValueError(f"checksum mismatch for {newkey}")
+            self.countVerified()
+        if not replace:
+            self.moved(key)
+        return len(data)
+
+    def countVerified(self):
+        with self.lock:
+            self.verified += 1
+
+    def moved(self, key):
+        if self.args.move:
+            self.source.deleteItem(key)
+
+    def attempt(self, key):
+        try:
+            return key, self.copyKey(key), None
+        except (StorageError, ValueError) as e:
+            return key, None, e
+
+    def run(self):
+        state = self.checkpoint.state
+        workers = max(1, self.args.workers)
+        lastsave = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix="migrate") as pool:
+            # keys that failed last time go first
+            retry, state["failed"] = state["failed"], []
+            for key, copied, error in pool.map(self.attempt, retry):
+                self.record(key, copied, error)
+
+            phases = self.phases()
+            while state["phase"] < len(phases):
+                prefix, delimiter, keep = phases[state["phase"]]
+                # keys of this phase in listing order, with done flags,
+                # so the checkpoint can advance past a contiguous run
+                order = deque()
+                done = {}
+                pending = {}
+                listing = self.source.listKeys(prefix, delimiter, state["after"])
+                for key in listing:
+                    if keep is not None and not keep(key):
+                        continue
+                    order.append(key)
+                    pending[pool.submit(self.attempt, key)] = key
+                    full = len(pending) >= 4 * workers
+                    pending = self.collect(pending, done,
+                                           FIRST_COMPLETED if full else None)
+                    self.advance(order, done)
+                    if time.monotonic() - lastsave > self.args.save_every:
+                        self.report()
+                        self.checkpoint.save()
+                        lastsave = time.monotonic()
+                self.collect(pending, done, ALL_COMPLETED)
+                self.advance(order, done)
+                state["phase"] += 1
+                state["after"] = None
+                self.checkpoint.save()
+        # a resumed run past its last phase only retried failed keys
+        self.checkpoint.save()
+        self.report()
+        return not state["failed"] and not self.mismatched
+
+    # until None only collects the copies already done
+    def collect(self, pending, done, until):
+        if until is None:
+            finished, rest = wait(pending, timeout=0)
+        else:
+            finished, rest = wait(pending, return_when=until)
+        for future in finished:
+            key, copied, error = future.result()
+            self.record(key, copied, error)
+            done[key] = True
+        return {f: pending[f] for f in rest}
+
+    def advance(self, order, done):
+        # move the watermark over the done prefix of order
+        state = self.checkpoint.state
+        while order and done.pop(order[0], False):
+            state["after"] = order.popleft()
+
+    def record(self, key, copied, error):
+        state = self.checkpoint.state
+        with self.lock:
+            if error is not None:
+                print(f"copy failed: {key}: {error}")
+                if isinstance(error, ValueError):
+                    self.mismatched += 1
+                state["failed"].append(key)
+            elif copied is None:
+                state["skipped"] = state.get("skipped", 0) + 1
+            else:
+                state["copied"] += 1
+                state["bytes"] += copied
+
+    def report(self):
+        state = self.checkpoint.state
+        elapsed = time.monotonic() - self.started
+        print(json.dumps({
+            "copied": state["copied"],
+            "bytes": state["bytes"],
+            "skipped": state.get("skipped", 0),
+            "failed": len(state["failed"]),
+            "verified": self.verified,
+            "after": state["after"],
+            "keysPerSecond": round(state["copied"] / elapsed, 1) if elapsed else None,
+        }))
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m cloud.storage.migrate",
+        description="Copy storage objects between backends, key layouts "
+                    "and blob formats.")
+    parser.add_argument("--source", help="s3://bucket, local:/dir or sqlite:/file")
+    parser.add_argument("--dest", help="as --source")
+    parser.add_argument("--path", nargs="*", default=[],
+                        help="only the tree under this path, e.g. home a@b.c")
+    parser.add_argument("--from-layout", choices=["json", "v2"],
+                        default=storage.STORAGE_KEY_LAYOUT)
+    parser.add_argument("--from-shards", type=int, default=storage.STORAGE_KEY_SHARDS)
+    parser.add_argument("--to-layout", choices=["json", "v2"],
+                        default=storage.STORAGE_KEY_LAYOUT)
+    parser.add_argument("--to-shards", type=int, default=storage.STORAGE_KEY_SHARDS)
+    parser.add_argument("--blobs", choices=["keep", "raw", "envelope"],
+                        default="keep", help="convert uploads on the way")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--checkpoint", help="file to save progress to and resume from")
+    parser.add_argument("--save-every", type=float, default=5.0,
+                        help="seconds between checkpoint saves")
+    parser.add_argument("--verify", action="store_true",
+                        help="read every copy back and compare checksums")
+    parser.add_argument("--move", action="store_true",
+                        help="delete each source key once it is copied")
+    args = parser.parse_args(argv)
+    if args.source == args.dest and args.from_layout == args.to_layout \
+            and args.from_shards == args.to_shards and args.blobs == "keep":
+        parser.error("source and destination are the same")
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    migration = Migration(openBackend(args.source), openBackend(args.dest), args)
+    return 0 if migration.run() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Storage Negative Lookups
+
+Most existence probes (is this user registered, is this upload name
+taken, does this parent directory exist) ask for keys that are not
+there, and every one of them would be a backend read returning
+nothing. Two structures answer definite misses locally:
+
+NegativeCache remembers keys a read found missing for a short ttl,
+the way the item cache remembers values; a write of the key forgets
+it at once.
+
+BloomFilters keeps a Bloom filter of the keys below chosen
+directories, built from a listing of the directory and refreshed
+every `refresh` seconds, and adds every key this process writes. A
+key the filter does not contain was not there at the last listing
+and was not written since by this process, so the filter is only
+definite about this process's own writes: a key another process
+created since the last listing reads as missing. It is meant for
+probes followed by a conditional create, which fails anyway if the
+key exists.
+
+Directories are given as patterns of "/" separated path elements, "*"
+matching any one element: "home/*" keeps one filter per home
+directory, built the first time a key below it is probed.
+"""
+
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from cloud.storage.cache import KeyMemo
+
+
+class NegativeCache(KeyMemo):
+    """Keys known to be missing, each for ttl seconds."""
+
+    def __init__(self, maxEntries, ttl):
+        super().__init__(maxEntries)
+        self.ttl = ttl
+        # bumped by every discard, see token()
+        self.writes = 0
+        self.hits = 0
+
+    def token(self):
+        """Taken before a backend read and handed back to add(), so a
+        miss read before a write of the key is not remembered after it."""
+        with self.lock:
+            return self.writes
+
+    def add(self, key, token=None):
+        with self.lock:
+            if token is not None and token != self.writes:
+                return
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def missing(self, key):
+        expires = self.get(key)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            super().discard(key)
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def discard(self, key):
+        with self.lock:
+            self.writes += 1
+        super().discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits}
+
+
+class BloomFilter:
+    """A Bloom filter for about capacity keys at the given false
+    positive rate."""
+    __slots__ = ("bits", "size", "hashes")
+
+    def __init__(self, capacity, errorRate):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(key))
+
+
+class DirFilter:
+    __slots__ = ("bloom", "built", "building", "pending")
+
+    def __init__(self):
+        self.bloom = None
+        self.built = 0.0
+        # keys written while the directory is being listed
+        self.building = False
+        self.pending = []
+
+
+class BloomFilters:
+    """Bloom filters of the keys below the directories matching
+    patterns.
+
+    listKeys(dirpath) lists every key below the directory at dirpath,
+    keyPath(key) is the path of a key, None for keys outside the file
+    tree. At most maxFilters filters are kept, least recently used
+    first out. A filter is sized for growth times the keys listed.
+    """
+
+    def __init__(self, patterns, listKeys, keyPath, refresh=60.0,
+                 errorRate=0.01, maxFilters=1000, growth=2):
+        # longest first, the most specific pattern gets the key
+        self.patterns = sorted((p.strip("/").split("/") for p in patterns
+                                if p.strip("/")), key=len, reverse=True)
+        self.listKeys = listKeys
+        self.keyPath = keyPath
+        self.refresh = refresh
+        self.errorRate = errorRate
+        self.maxFilters = maxFilters
+        self.growth = growth
+        self.filters = OrderedDict()
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.builds = 0
+
+    def dirFor(self, key):
+        """The directory whose filter covers key, as a tuple, or None."""
+        path = self.keyPath(key)
+        if path is None:
+            return None
+        for pattern in self.patterns:
+            if len(path) > len(pattern) and all(
+                    p == "*" or p == e for p, e in zip(pattern, path)):
+                return tuple(path[:len(pattern)])
+        return None
+
+    def add(self, key):
+        """key may exist from now on."""
+        dirpath = self.dirFor(key)
+        if dirpath is None:
+            return
+        with self.lock:
+            entry = self.filters.get(dirpath)
+            if entry is None:
+                return
+            if entry.bloom is not None:
+                entry.bloom.add(key)
+            if entry.building:
+                entry.pending.append(key)
+
+    def absent(self, keys):
+        """True when none of keys, all below one directory, can exist
+        as far as its filter knows; False when they may, or while the
+        filter is being built. A missing or outdated filter is built
+        by the first caller needing it."""
+        dirpath = self.dirFor(keys[0])
+        if dirpath is None:
+            return False
+        with self.lock:
+            entry = self.filters.get(dirpath)
+            if entry is None:
+                entry = self.filters[dirpath] = DirFilter()
+                while len(self.filters) > self.maxFilters:
+                    self.filters.popitem(last=False)
+            self.filters.move_to_end(dirpath)
+            current = entry.bloom is not None and \
+                time.monotonic() - entry.built < self.refresh
+            if not current:
+                if entry.building:
+                    return False
+                entry.building = True
+                entry.pending = []
+        if not current:
+            self.build(dirpath, entry)
+        with self.lock:
+            if entry.bloom is None or any(key in entry.bloom for key in keys):
+                return False
+            self.rejected += 1
+            return True
+
+    def build(self, dirpath, entry):
+        started = time.monotonic()
+        try:
+            keys = list(self.listKeys(list(dirpath)))
+        except Exception as e:
+            print(f"Error listing {list(dirpath)} for its filter: {e}")
+            with self.lock:
+                entry.building = False
+            return
+        bloom = BloomFilter(len(keys) * self.growth + 64, self.errorRate)
+        for key in keys:
+            bloom.add(key)
+        with self.lock:
+            for key in entry.pending:
+                bloom.add(key)
+            entry.bloom = bloom
+            entry.built = started
+            entry.building = False
+            entry.pending = []
+            self.builds += 1
+
+    def clear(self):
+        with self.lock:
+            self.filters.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"filters": len(self.filters), "rejected": self.rejected,
+                    "builds": self.builds}
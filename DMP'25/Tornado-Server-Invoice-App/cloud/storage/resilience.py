@@ -0,0 +1,207 @@
+"""
+Storage Resilience
+
+A backend wrapper that retries transient failures and hedges slow reads.
+
+Retries use full-jitter exponential backoff and stop when the next
+attempt could not finish before the call's deadline. Puts that only
+apply under a condition (ifNoneMatch/ifMatch) are not retried after an
+ambiguous failure, since the first attempt may have landed and the
+retry would then report a false PreconditionFailed.
+
+With hedging on, a get still running after the recent p95 latency of
+gets is sent a second time and whichever answer comes first is used.
+Configured from the environment by fromEnv:
+
+    STORAGE_RETRY_ATTEMPTS   - attempts per call, 1 disables retries
+    STORAGE_RETRY_BASE_MS    - first backoff, doubled per attempt
+    STORAGE_RETRY_MAX_MS     - backoff cap
+    STORAGE_DEADLINE_MS      - total time a call may take
+    STORAGE_HEDGE            - true to hedge gets
+    STORAGE_HEDGE_MIN_MS     - never hedge sooner than this
+"""
+
+import os
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from cloud.storage.backends import StorageBackend, TransientError
+from cloud.storage.metrics import TracedExecutor
+
+
+class LatencyWindow:
+    """The last size latencies, for a rolling percentile."""
+
+    def __init__(self, size=256, minSamples=20):
+        self.samples = deque(maxlen=size)
+        self.minSamples = minSamples
+        self.lock = threading.Lock()
+        self.cached = None
+        self.added = 0
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.added += 1
+            # re-sorting on every sample is wasteful, every 16th will do
+            if self.added % 16 == 0:
+                self.cached = None
+
+    def percentile(self, p):
+        """Seconds, or None until enough samples are in."""
+        with self.lock:
+            if len(self.samples) < self.minSamples:
+                return None
+            if self.cached is None:
+                self.cached = sorted(self.samples)
+            ordered = self.cached
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class ResilientBackend(StorageBackend):
+    def __init__(self, inner, attempts=3, baseDelay=0.05, maxDelay=2.0,
+                 deadline=10.0, hedge=False, hedgeMin=0.02, hedgeWorkers=32):
+        self.inner = inner
+        self.name = inner.name
+        self.attempts = max(1, attempts)
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedgeMin = hedgeMin
+        self.latency = LatencyWindow()
+        self.pool = TracedExecutor(max_workers=hedgeWorkers,
+                                   thread_name_prefix="hedge") if hedge else None
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0, "attempts": 0, "retries": 0, "failures": 0,
+            "hedges": 0, "hedgeWins": 0,
+        }
+
+    # anything the wrapper does not handle, e.g. the S3 client
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        p95 = self.latency.percentile(0.95)
+        stats["getP95Ms"] = None if p95 is None else round(p95 * 1000, 2)
+        return stats
+
+    def call(self, fn, args, safe=True):
+        """Run fn(*args) with retries, safe=False for non-idempotent calls."""
+        self.count("calls")
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.count("attempts")
+            try:
+                return fn(*args)
+            except TransientError as e:
+                if attempt >= self.attempts or (e.ambiguous and not safe):
+                    self.count("failures")
+                    raise
+                cap = min(self.maxDelay, self.baseDelay * (2 ** (attempt - 1)))
+                delay = random.uniform(0, cap)
+                elapsed = time.monotonic() - start
+                p95 = self.latency.percentile(0.95) or 0
+                if elapsed + delay + p95 > self.deadline:
+                    self.count("failures")
+                    raise
+                self.count("retries")
+                time.sleep(delay)
+
+    def timedGet(self, fn, args):
+        start = time.monotonic()
+        result = fn(*args)
+        self.latency.add(time.monotonic() - start)
+        return result
+
+    def hedged(self, fn, args):
+        """One attempt of a get, sent twice if the first one is slow."""
+        p95 = self.latency.percentile(0.95)
+        if self.pool is None or p95 is None:
+            return self.timedGet(fn, args)
+        first = self.pool.submit(self.timedGet, fn, args)
+        done, _ = wait([first], timeout=max(p95, self.hedgeMin))
+        if done:
+            return first.result()
+        self.count("hedges")
+        second = self.pool.submit(self.timedGet, fn, args)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.count("hedgeWins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        conditional = ifNoneMatch or ifMatch is not None
+        return self.call(self.inner.putItem,
+                         (key, data, metadata, ifNoneMatch, ifMatch),
+                         safe=not conditional)
+
+    def getItem(self, key):
+        return self.call(self.hedged, (self.inner.getItem, (key,)))
+
+    def deleteItem(self, key):
+        return self.call(self.inner.deleteItem, (key,))
+
+    def getItemIfChanged(self, key, etag=None):
+        return self.call(self.hedged,
+                         (self.inner.getItemIfChanged, (key, etag)))
+
+    # a listing is a stream of pages, it is not retried as a whole
+    def listKeys(self, prefix, delimiter=None, startAfter=None):
+        return self.inner.listKeys(prefix, delimiter, startAfter)
+
+    def deleteItems(self, keys):
+        return self.call(self.inner.deleteItems, (list(keys),))
+
+    # opening is retried, reading the stream is not; not hedged, the
+    # losing stream would hold a connection until collected
+    def openRead(self, key):
+        return self.call(self.inner.openRead, (key,))
+
+    def openWrite(self, key, metadata=None, ifNoneMatch=False, ifMatch=None):
+        writer = self.inner.openWrite(key, metadata, ifNoneMatch, ifMatch)
+        if hasattr(writer, "call"):
+            # writers sending several requests retry each of them
+            writer.call = self.call
+        return writer
+
+
+def envFlag(name, default):
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+def fromEnv(inner):
+    """Wrap inner as configured, or return it as is when both retries
+    and hedging are off."""
+    attempts = int(os.getenv("STORAGE_RETRY_ATTEMPTS", "3"))
+    hedge = envFlag("STORAGE_HEDGE", "false")
+    if attempts <= 1 and not hedge:
+        return inner
+    return ResilientBackend(
+        inner,
+        attempts=attempts,
+        baseDelay=float(os.getenv("STORAGE_RETRY_BASE_MS", "50")) / 1000,
+        maxDelay=float(os.getenv("STORAGE_RETRY_MAX_MS", "2000")) / 1000,
+        deadline=float(os.getenv("STORAGE_DEADLINE_MS", "10000")) / 1000,
+        hedge=hedge,
+        hedgeMin=float(os.getenv("STORAGE_HEDGE_MIN_MS", "20")) / 1000)
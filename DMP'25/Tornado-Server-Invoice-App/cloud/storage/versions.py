@@ -0,0 +1,135 @@
+"""
+Storage Version History
+
+The history of a file's content as a chain of runs. A run is a full
+snapshot of one version, its base, followed by up to K line level
+deltas, each turning one version into the next:
+
+    run 1:   base v1, delta v1->v2, delta v2->v3, ... (K deltas)
+    run K+2: base vK+2, ...
+
+so any version is rebuilt from its run with at most K deltas applied.
+A run is closed after K deltas, or early when a delta would not be
+much smaller than the content itself (a rewrite, or content with few
+line breaks), and the next version starts a new run.
+
+A delta is a json list of ops on the lines of the previous version:
+a positive int copies that many lines, a negative int skips that many
+and a list of strings inserts those lines.
+
+The history record holds the open run and the list of versions:
+
+    {"next": n, "run": first version of the open run,
+     "base": content, "deltas": [delta, ...],
+     "versions": [{"n": n, "at": iso time, "size": n, "run": first}, ...]}
+
+closed runs are stored apart as {"base": ..., "deltas": [...]}. Only
+the functions here know the format; storage reads and writes the
+records.
+"""
+
+import json
+import difflib
+
+# a delta at least this share of the content's size starts a new run
+MAX_DELTA_SHARE = 0.5
+
+
+def makeDelta(old, new):
+    """The delta turning old into new."""
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, a, b).get_opcodes():
+        if tag == "equal":
+            delta.append(i2 - i1)
+            continue
+        if tag in ("delete", "replace"):
+            delta.append(i1 - i2)
+        if tag in ("insert", "replace"):
+            delta.append(b[j1:j2])
+    return delta
+
+
+def applyDelta(old, delta):
+    lines = old.splitlines(keepends=True)
+    out = []
+    pos = 0
+    for op in delta:
+        if isinstance(op, list):
+            out.extend(op)
+        elif op > 0:
+            out.extend(lines[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return "".join(out)
+
+
+def replay(run, count):
+    """The content of the version count deltas after run's base."""
+    data = run["base"]
+    for delta in run["deltas"][:count]:
+        data = applyDelta(data, delta)
+    return data
+
+
+def openRun(history):
+    return {"base": history["base"], "deltas": history["deltas"]}
+
+
+def addVersion(history, data, at, maxDeltas, keep):
+    """Add data as the newest version of history, None for a new one.
+
+    keep is the number of versions retained at least, older runs are
+    dropped whole. Returns (history, (first, run) of the run closed by
+    this version or None, firsts of the closed runs dropped), or None
+    when data is the newest version already.
+    """
+    if history is None:
+        history = {"next": 1, "run": None, "base": None, "deltas": [],
+                   "versions": []}
+    n = history["next"]
+    closed = None
+    delta = None
+    if history["run"] is not None:
+        latest = replay(openRun(history), len(history["deltas"]))
+        if latest == data:
+            return None
+        if len(history["deltas"]) < maxDeltas:
+            delta = makeDelta(latest, data)
+            if len(json.dumps(delta)) >= MAX_DELTA_SHARE * len(data):
+                delta = None
+        if delta is None:
+            closed = (history["run"], openRun(history))
+    if delta is None:
+        history.update(run=n, base=data, deltas=[])
+    else:
+        history["deltas"].append(delta)
+    history["next"] = n + 1
+    history["versions"].append({"n": n, "at": at, "size": len(data),
+                                "run": history["run"]})
+
+    dropped = []
+    versions = history["versions"]
+    while True:
+        first = versions[0]["run"]
+        older = sum(1 for v in versions if v["run"] == first)
+        if first == history["run"] or len(versions) - older < keep:
+            break
+        del versions[:older]
+        dropped.append(first)
+    if closed is not None and closed[0] in dropped:
+        # dropped as it closes, it was never stored apart
+        dropped.remove(closed[0])
+        closed = None
+    return history, closed, dropped
+
+
+def findVersion(history, n):
+    """The entry of version n in history, None if it is not kept."""
+    for version in (history or {}).get("versions", []):
+        if version["n"] == n:
+            return version
+    return None
@@ -35,7 +35,9 @@ import imghdr
 import mimetypes
 
 import json
+import hmac
 import cloud.storage.storage
+import cloud.storage.metrics
 import cloud.authenticate.user
 
 try:
@@ -60,6 +62,8 @@ import time
 import base64
 JWT_SECRET = "your-secret-key-change-this-in-production"  # Change this!
 JWT_ALGORITHM = "HS256"
+# bearer token a scraper sends to read /metrics, unset keeps it off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 channels = {}
 
 # PDF Configuration
@@ -140,6 +144,7 @@ class Application(tornado.web.Application):
             (r"/logos/([^/]+)", LogoServeHandler),
             (r"/login", UserLoginHandler),
             (r"/register", UserRegisterHandler),
+            (r"/metrics", MetricsHandler),
         ]
         settings = dict(
             app_title="Aspiring Investments",
@@ -185,6 +190,16 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_status(204)
         self.finish()
 
+    def prepare(self):
+        # storage calls made for this request are traced under the handler
+        self.storage_trace = cloud.storage.metrics.startTrace(
+            type(self).__name__)
+
+    def on_finish(self):
+        trace = getattr(self, "storage_trace", None)
+        if trace is not None:
+            cloud.storage.metrics.endTrace(trace)
+
     @property
     def db(self):
         return self.application.db
@@ -225,22 +240,45 @@ class BaseHandler(tornado.web.RequestHandler):
         return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+class MetricsHandler(BaseHandler):
+    async def get(self):
+        """Storage metrics for a scraper, in the Prometheus text format,
+        or as json with ?format=json"""
+        if not METRICS_TOKEN:
+            raise tornado.web.HTTPError(404)
+        auth_header = self.request.headers.get('Authorization', '')
+        token = auth_header[len('Bearer '):] if auth_header.startswith(
+            'Bearer ') else auth_header
+        if not hmac.compare_digest(token.encode('utf-8'),
+                                   METRICS_TOKEN.encode('utf-8')):
+            self.set_status(401)
+            self.finish({"error": "Unauthorized"})
+            return
+        if self.get_argument("format", None) == "json":
+            self.finish(cloud.storage.storage.storageStats())
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(cloud.storage.metrics.registry.prometheus())
+
+
 class UserLoginHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         # send the login/pw page
         argument = {}
         self.clear_cookie("user")
         argument['user'] = None
         self.render("userlogin.html", argument=argument)
 
-    def post(self):
+    async def post(self):
         # verify user login
         user = self.get_argument('email')
         password = self.get_argument('password')
         # Check if it's a React app
         react_app = self.get_argument('react_app', None)
 
-        if cloud.authenticate.user.authenticate_user(user, password):
+        authenticated = await cloud.storage.storage.runAsync(
+            cloud.authenticate.user.authenticate_user, user, password)
+        if authenticated:
             print("authenticate succeeded")
 
             if react_app:
@@ -271,14 +309,14 @@ class UserLoginHandler(BaseHandler):
 
 
 class UserRegisterHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         # send the login/pw page
         self.clear_cookie("user")
         argument = {}
         argument['user'] = None
         self.render("userregister.html", argument=argument)
 
-    def post(self):
+    async def post(self):
         user = self.get_argument('email')
         password = self.get_argument('password')
         # Check if it's a React app
@@ -287,7 +325,17 @@ class UserRegisterHandler(BaseHandler):
         logging.info(f"Registration attempt for user: {user}")
         logging.info(f"React app: {react_app}")
 
-        if cloud.authenticate.user.user_exists(user):
+        exists = await cloud.storage.storage.runAsync(
+            cloud.authenticate.user.user_exists, user)
+        created = False
+        if not exists:
+            created = await cloud.storage.storage.runAsync(
+                cloud.authenticate.user.create_user, user, password)
+            if not created:
+                # registered meanwhile or elsewhere, or the write failed
+                exists = await cloud.storage.storage.runAsync(
+                    cloud.authenticate.user.user_exists, user, True)
+        if exists:
             # user already exists
             if react_app:
                 # Return JSON response for React apps
@@ -306,7 +354,18 @@ class UserRegisterHandler(BaseHandler):
                 self.render("userregister-exists.html", argument=argument)
             return
 
-        cloud.authenticate.user.create_user(user, password)
+        if not created:
+            logging.error(f"Registration failed for user: {user}")
+            if react_app:
+                self.set_status(500)
+                self.finish({
+                    "success": False,
+                    "error": "REGISTRATION_FAILED",
+                    "message": "Registration failed, please try again"
+                })
+            else:
+                self.redirect("/register")
+            return
 
         if react_app:
             # Return Registration success response for React apps
@@ -324,7 +383,7 @@ class UserRegisterHandler(BaseHandler):
 
 
 class SaveHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         # display all sheets
         user = self.get_current_user()
         if user == None:
@@ -332,10 +391,10 @@ class SaveHandler(BaseHandler):
             self.redirect("/dev")
             return
         path = ["home", user]
-        dirobj = cloud.storage.storage.getFile(path)
-        if (not dirobj) or (len(dirobj.files) == 0):
+        dirobj = await cloud.storage.storage.getFileAsync(path)
+        if (not dirobj) or (len(dirobj.names) == 0):
             logging.info("no directory")
-            cloud.storage.storage.createDir(path)
+            await cloud.storage.storage.createDirAsync(path)
             filedata = {}
             filedata["user"] = user
             filedata["fname"] = "default"
@@ -343,8 +402,8 @@ class SaveHandler(BaseHandler):
             fpath = path[:]
             fpath.append("default")
             logging.info(fpath)
-            cloud.storage.storage.createFile(fpath, json.dumps(filedata))
-            dirobj = cloud.storage.storage.getFile(path)
+            await cloud.storage.storage.createFileAsync(fpath, json.dumps(filedata))
+            dirobj = await cloud.storage.storage.getFileAsync(path)
         entries = dirobj.files
         logging.info(entries)
         argument = {}
@@ -354,7 +413,7 @@ class SaveHandler(BaseHandler):
         logging.info(str(argument['entries']))
         self.render("allusersheets.html", argument=argument)
 
-    def post(self):
+    async def post(self):
         user = self.get_current_user()
         if user == None:
             # this cannot happen
@@ -365,11 +424,7 @@ class SaveHandler(BaseHandler):
         sheetstr = self.get_argument("data", None)
         path = ["home", user, fname]
         if sheetstr != None:
-            fileobj = cloud.storage.storage.getFile(path)
-            if fileobj == None:
-                cloud.storage.storage.createFile(path, sheetstr)
-            else:
-                cloud.storage.storage.updateFile(path, sheetstr)
+            await cloud.storage.storage.saveFileAsync(path, sheetstr)
         self.finish(dict(data="Done"))
 
 
@@ -377,7 +432,7 @@ class SaveHandler(BaseHandler):
 
 class FileOpsHandler(BaseHandler):
 
-    def get(self):
+    async def get(self):
         """Get list of user files or download a specific file"""
         user = self.get_current_user()
         if user is None:
@@ -394,64 +449,61 @@ class FileOpsHandler(BaseHandler):
                 user_path = ["home", user]
                 file_path = user_path + [filename]
 
-                # Use fetchFile function from storage
-                file_content = cloud.storage.storage.fetchFile(file_path)
+                # Raw blobs are streamed, base64 envelopes come back whole
+                blob = await cloud.storage.storage.openBlobAsync(file_path)
 
-                if file_content is None:
+                if blob is None:
                     self.set_status(404)
                     self.finish({"error": "File not found"})
                     return
 
-                # Parse file content to get metadata and actual content
-                try:
-                    file_data = json.loads(file_content)
-                    if "metadata" in file_data and "content" in file_data:
-                        metadata = file_data["metadata"]
-                        content = file_data["content"]
-
-                        # Handle different encodings
-                        if metadata.get("encoding") == "base64":
-                            # Decode base64 content
-                            actual_content = base64.b64decode(content)
-                            content_type = metadata.get(
-                                "content_type", "application/octet-stream")
-                        else:
-                            # Text content
-                            actual_content = content.encode(
-                                'utf-8') if isinstance(content, str) else content
-                            content_type = metadata.get(
-                                "content_type", "text/plain")
-
-                        # Set appropriate headers
-                        self.set_header("Content-Type", content_type)
-                        self.set_header("Content-Disposition",
-                                        f'attachment; filename="{filename}"')
-                        self.set_header("Content-Length",
-                                        str(len(actual_content)))
-
-                        self.write(actual_content)
-                        self.finish()
-                        return
+                reader, metadata = blob
+                if metadata is not None:
+                    if metadata.get("encoding") == "text":
+                        content_type = metadata.get(
+                            "content_type", "text/plain")
                     else:
-                        # Legacy file format - return as text
-                        self.set_header("Content-Type", "text/plain")
-                        self.set_header("Content-Disposition",
-                                        f'attachment; filename="{filename}"')
-                        self.write(file_content.encode('utf-8'))
-                        self.finish()
-                        return
+                        content_type = metadata.get(
+                            "content_type", "application/octet-stream")
 
-                except json.JSONDecodeError:
-                    # Raw file content
-                    self.set_header("Content-Type", "application/octet-stream")
+                    # Set appropriate headers
+                    self.set_header("Content-Type", content_type)
                     self.set_header("Content-Disposition",
                                     f'attachment; filename="{filename}"')
-                    content_bytes = file_content.encode(
-                        'utf-8') if isinstance(file_content, str) else file_content
-                    self.write(content_bytes)
+                    if reader.size is not None:
+                        self.set_header("Content-Length", str(reader.size))
+
+                    # Send the file a chunk at a time
+                    try:
+                        async for chunk in cloud.storage.storage.iterChunksAsync(reader):
+                            self.write(chunk)
+                            await self.flush()
+                    except Exception as e:
+                        # The headers are out, the response can only be cut short
+                        logging.error(f"Error streaming file: {e}")
+                        self.request.connection.close()
+                        return
                     self.finish()
                     return
 
+                # Files without upload metadata, already read whole
+                file_content = reader.read()
+                reader.close()
+                try:
+                    json.loads(file_content)
+                    # Legacy file format - return as text
+                    content_type = "text/plain"
+                except ValueError:
+                    # Raw file content
+                    content_type = "application/octet-stream"
+
+                self.set_header("Content-Type", content_type)
+                self.set_header("Content-Disposition",
+                                f'attachment; filename="{filename}"')
+                self.write(file_content)
+                self.finish()
+                return
+
             except Exception as e:
                 logging.error(f"Error downloading file: {e}")
                 self.set_status(500)
@@ -462,17 +514,46 @@ class FileOpsHandler(BaseHandler):
         try:
             # Get user directory
             user_path = ["home", user]
-            dirobj = cloud.storage.storage.getFile(user_path)
-
-            if not dirobj:
-                self.finish({"files": []})
-                return
+            # With a metadata catalog the listing is one indexed query,
+            # the rows of a user written before it are filled on the
+            # first one; otherwise it comes from the directory object
+            entries = await cloud.storage.storage.listCatalogAsync(user_path)
+            if entries is None:
+                dirobj = await cloud.storage.storage.getFileAsync(user_path)
+
+                if not dirobj:
+                    self.finish({"files": []})
+                    return
+                entries = dirobj.entries()
 
             files = []
-            for file_obj in dirobj.files:
-                filename = file_obj.fname
+            for filename, entry in entries:
                 file_path = user_path + [filename]
-                file_data = cloud.storage.storage.getFile(file_path)
+
+                # The directory manifest already carries the upload
+                # metadata, or the size and times of a saved sheet, so
+                # only files listed without an entry need to be fetched
+                if entry and "metadata" in entry:
+                    metadata = entry["metadata"]
+                    files.append({
+                        "id": hash(filename),
+                        "filename": metadata.get("filename", filename),
+                        "s3_key": metadata.get("s3_key", ""),
+                        "created_at": metadata.get("created_at", ""),
+                        "file_size": metadata.get("file_size", 0)
+                    })
+                    continue
+                if entry:
+                    files.append({
+                        "id": hash(filename),
+                        "filename": filename,
+                        "s3_key": cloud.storage.storage.pathToString(file_path),
+                        "created_at": entry.get("created_at") or entry.get("modified_at", ""),
+                        "file_size": entry.get("size", 0)
+                    })
+                    continue
+
+                file_data = await cloud.storage.storage.getFileAsync(file_path)
 
                 if file_data and hasattr(file_data, 'data'):
                     try:
@@ -495,7 +576,7 @@ class FileOpsHandler(BaseHandler):
                                 "created_at": datetime.utcnow().isoformat(),
                                 "file_size": len(file_data.data) if file_data.data else 0
                             })
-                    except (json.JSONDecodeError, AttributeError):
+                    except (ValueError, AttributeError):
                         # Handle corrupted or invalid data
                         continue
 
@@ -506,7 +587,7 @@ class FileOpsHandler(BaseHandler):
             self.set_status(500)
             self.finish({"error": "Internal server error"})
 
-    def post(self):
+    async def post(self):
         """Upload file to S3 storage"""
         user = self.get_current_user()
         if user is None:
@@ -532,18 +613,23 @@ class FileOpsHandler(BaseHandler):
                 self.finish({"error": "Invalid filename"})
                 return
 
+            # Check the user's storage quota before anything is written
+            if not await cloud.storage.storage.checkQuotaAsync(user, len(file_content)):
+                self.set_status(413)
+                self.finish({"error": "Storage quota exceeded"})
+                return
+
             # Create user directory if it doesn't exist
             user_path = ["home", user]
-            dirobj = cloud.storage.storage.getFile(user_path)
-            if not dirobj:
-                cloud.storage.storage.createDir(user_path)
+            if not await cloud.storage.storage.fileExistsAsync(user_path):
+                await cloud.storage.storage.createDirAsync(user_path)
 
             # Create file path
             file_path = user_path + [filename]
 
-            # Check if file already exists
-            existing_file = cloud.storage.storage.getFile(file_path)
-            if existing_file:
+            # Check if file already exists; mostly answered without a
+            # storage read, the create below fails if it does exist
+            if await cloud.storage.storage.fileExistsAsync(file_path):
                 self.set_status(409)
                 self.finish({"error": "File already exists"})
                 return
@@ -557,24 +643,15 @@ class FileOpsHandler(BaseHandler):
                 "content_type": file_data.get('content_type', 'application/octet-stream')
             }
 
-            # Encode file content for storage
-            if isinstance(file_content, bytes):
-                encoded_content = base64.b64encode(
-                    file_content).decode('utf-8')
-                file_metadata["encoding"] = "base64"
-            else:
-                encoded_content = file_content
+            # Store the raw bytes, the metadata travels with the blob
+            if isinstance(file_content, str):
+                file_content = file_content.encode('utf-8')
                 file_metadata["encoding"] = "text"
 
-            # Store file with metadata
-            file_data_with_meta = {
-                "metadata": file_metadata,
-                "content": encoded_content
-            }
-
-            # Create file in storage
-            success = cloud.storage.storage.createFile(
-                file_path, json.dumps(file_data_with_meta))
+            # Create file in storage, copied over in chunks so large
+            # uploads go to S3 as multipart uploads
+            success = await cloud.storage.storage.createBlobFromAsync(
+                file_path, io.BytesIO(file_content), file_metadata)
 
             if success:
                 self.finish({
@@ -583,6 +660,10 @@ class FileOpsHandler(BaseHandler):
                     "file_id": hash(filename),  # Simple ID generation
                     "filename": filename
                 })
+            elif await cloud.storage.storage.fileExistsAsync(file_path, revalidate=True):
+                # created meanwhile, or missed by the probe above
+                self.set_status(409)
+                self.finish({"error": "File already exists"})
             else:
                 self.set_status(500)
                 self.finish({"error": "Failed to upload file"})
@@ -592,7 +673,7 @@ class FileOpsHandler(BaseHandler):
             self.set_status(500)
             self.finish({"error": "Internal server error"})
 
-    def delete(self):
+    async def delete(self):
         """Delete a specific file"""
         user = self.get_current_user()
         if user is None:
@@ -620,14 +701,14 @@ class FileOpsHandler(BaseHandler):
             file_path = user_path + [filename]
 
             # Check if file exists
-            existing_file = cloud.storage.storage.getFile(file_path)
+            existing_file = await cloud.storage.storage.getFileAsync(file_path)
             if not existing_file:
                 self.set_status(404)
                 self.finish({"error": "File not found"})
                 return
 
             # Delete the file
-            success = cloud.storage.storage.deleteFile(file_path)
+            success = await cloud.storage.storage.deleteFileAsync(file_path)
 
             if success:
                 self.finish({
@@ -679,7 +760,7 @@ class LogosHandler(BaseHandler):
             logging.error(f"Error validating image file: {e}")
             return False
 
-    def get(self):
+    async def get(self):
         """Get all logos for authenticated user"""
         try:
             user = self.get_current_user()
@@ -688,27 +769,36 @@ class LogosHandler(BaseHandler):
                 self.finish({"error": "Authentication required"})
                 return
 
-            # Get user's logos directory
+            # Get user's logos directory, read a page at a time; a
+            # missing directory lists as empty
             logos_path = ["home", user, "logos"]
-            dirobj = cloud.storage.storage.getFile(logos_path)
-
-            if not dirobj:
-                # No logos directory exists, return empty list
-                self.finish({
-                    "success": True,
-                    "logos": []
-                })
-                return
 
             logos = []
-            for file_obj in dirobj.files:
-                filename = file_obj.fname
+            async for filename, entry in cloud.storage.storage.iterDirAsync(logos_path):
                 file_path = logos_path + [filename]
-                file_data = cloud.storage.storage.getFile(file_path)
 
-                if file_data and hasattr(file_data, 'data'):
+                # Use the directory manifest when it has an entry, with
+                # the upload metadata or only the size and times,
+                # otherwise fall back to fetching the file itself
+                if entry and "metadata" in entry:
+                    file_json = {"metadata": entry["metadata"]}
+                elif entry:
+                    file_json = {"metadata": {
+                        "file_size": entry.get("size", 0),
+                        "created_at": entry.get("created_at") or entry.get("modified_at", "")
+                    }}
+                else:
+                    file_json = None
+                    file_data = await cloud.storage.storage.getFileAsync(file_path)
+                    if file_data and hasattr(file_data, 'data'):
+                        try:
+                            file_json = json.loads(file_data.data)
+                        except (ValueError, TypeError):
+                            # Handle corrupted or invalid data
+                            continue
+
+                if file_json:
                     try:
-                        file_json = json.loads(file_data.data)
                         if "metadata" in file_json:
                             metadata = file_json["metadata"]
                             # Use the public_filename for the URL
@@ -737,7 +827,7 @@ class LogosHandler(BaseHandler):
             self.set_status(500)
             self.finish({"error": "Internal server error"})
 
-    def post(self):
+    async def post(self):
         """Upload a logo for authenticated user"""
         try:
             user = self.get_current_user()
@@ -777,6 +867,12 @@ class LogosHandler(BaseHandler):
                     {"error": "File size too large. Maximum 5MB allowed"})
                 return
 
+            # Check the user's storage quota before anything is written
+            if not await cloud.storage.storage.checkQuotaAsync(user, len(file_content)):
+                self.set_status(413)
+                self.finish({"error": "Storage quota exceeded"})
+                return
+
             # Generate unique filename for public access
             file_extension = original_filename.rsplit(
                 '.', 1)[1].lower() if '.' in original_filename else ''
@@ -788,23 +884,20 @@ class LogosHandler(BaseHandler):
 
             # Store in user's private directory for ownership tracking
             user_logos_path = ["home", user, "logos"]
-            dirobj = cloud.storage.storage.getFile(user_logos_path)
-            if not dirobj:
-                cloud.storage.storage.createDir(user_logos_path)
+            if not await cloud.storage.storage.fileExistsAsync(user_logos_path):
+                await cloud.storage.storage.createDirAsync(user_logos_path)
 
             # Also store in public logos directory
             public_logos_path = ["logos"]
-            public_dirobj = cloud.storage.storage.getFile(public_logos_path)
-            if not public_dirobj:
-                cloud.storage.storage.createDir(public_logos_path)
+            if not await cloud.storage.storage.fileExistsAsync(public_logos_path):
+                await cloud.storage.storage.createDirAsync(public_logos_path)
 
             # Create file paths
             user_file_path = user_logos_path + [unique_filename]
             public_file_path = public_logos_path + [public_filename]
 
             # Check if file already exists (very unlikely with UUID)
-            existing_file = cloud.storage.storage.getFile(user_file_path)
-            if existing_file:
+            if await cloud.storage.storage.fileExistsAsync(user_file_path):
                 self.set_status(409)
                 self.finish({"error": "File already exists"})
                 return
@@ -820,23 +913,13 @@ class LogosHandler(BaseHandler):
                 "content_type": file_data.get('content_type', mimetypes.guess_type(original_filename)[0] or 'application/octet-stream')
             }
 
-            # Encode file content for storage
-            encoded_content = base64.b64encode(file_content).decode('utf-8')
-            file_metadata["encoding"] = "base64"
-
-            # Store file with metadata
-            file_data_with_meta = {
-                "metadata": file_metadata,
-                "content": encoded_content
-            }
-
-            # Create file in both user directory (for ownership) and public directory
-            user_success = cloud.storage.storage.createFile(
-                user_file_path, json.dumps(file_data_with_meta))
-            public_success = cloud.storage.storage.createFile(
-                public_file_path, json.dumps(file_data_with_meta))
+            # Create file in both user directory (for ownership) and public
+            # directory, the batch undoes both if either fails
+            batch = cloud.storage.storage.Batch()
+            batch.createBlob(user_file_path, file_content, file_metadata)
+            batch.createBlob(public_file_path, file_content, file_metadata)
 
-            if user_success and public_success:
+            if await batch.commitAsync():
                 logo_id = hash(unique_filename)
                 self.finish({
                     "success": True,
@@ -847,11 +930,6 @@ class LogosHandler(BaseHandler):
                     "message": "Logo uploaded successfully"
                 })
             else:
-                # Clean up if one failed
-                if user_success:
-                    cloud.storage.storage.deleteFile(user_file_path)
-                if public_success:
-                    cloud.storage.storage.deleteFile(public_file_path)
                 self.set_status(500)
                 self.finish({"error": "Failed to upload logo"})
 
@@ -860,7 +938,7 @@ class LogosHandler(BaseHandler):
             self.set_status(500)
             self.finish({"error": "Internal server error"})
 
-    def delete(self):
+    async def delete(self):
         """Delete a specific logo for authenticated user"""
         try:
             user = self.get_current_user()
@@ -895,16 +973,15 @@ class LogosHandler(BaseHandler):
             user_file_path = user_logos_path + [logo_filename]
 
             # Check if file exists and belongs to user
-            existing_file = cloud.storage.storage.getFile(user_file_path)
+            existing_file = await cloud.storage.storage.getBlobAsync(user_file_path)
             if not existing_file:
                 self.set_status(404)
                 self.finish({"error": "Logo not found or access denied"})
                 return
 
             # Get the public filename from metadata
-            try:
-                file_json = json.loads(existing_file.data)
-                metadata = file_json.get("metadata", {})
+            metadata = existing_file[1]
+            if metadata is not None:
                 public_filename = metadata.get(
                     "public_filename", logo_filename)
 
@@ -913,17 +990,16 @@ class LogosHandler(BaseHandler):
                     self.set_status(403)
                     self.finish({"error": "Access denied"})
                     return
-
-            except (json.JSONDecodeError, KeyError):
+            else:
                 # Fallback for legacy files
                 public_filename = logo_filename
 
             # Delete from both user directory and public directory
-            user_success = cloud.storage.storage.deleteFile(user_file_path)
+            user_success = await cloud.storage.storage.deleteFileAsync(user_file_path)
 
             public_logos_path = ["logos"]
             public_file_path = public_logos_path + [public_filename]
-            public_success = cloud.storage.storage.deleteFile(public_file_path)
+            public_success = await cloud.storage.storage.deleteFileAsync(public_file_path)
 
             if user_success:
                 self.finish({
@@ -942,59 +1018,39 @@ class LogosHandler(BaseHandler):
 
 # Handler to serve logo files directly
 class LogoServeHandler(BaseHandler):
-    def get(self, filename):
+    async def get(self, filename):
         """Serve logo files directly from public directory - no authentication required"""
         try:
             # Create file path for public logos directory
             logos_path = ["logos", filename]
-            file_data = cloud.storage.storage.getFile(logos_path)
+            blob = await cloud.storage.storage.getBlobAsync(logos_path)
 
-            if not file_data or not hasattr(file_data, 'data'):
+            if not blob:
                 self.set_status(404)
                 self.finish({"error": "Logo not found"})
                 return
 
-            try:
-                file_json = json.loads(file_data.data)
-                if "metadata" in file_json and "content" in file_json:
-                    metadata = file_json["metadata"]
-                    content = file_json["content"]
-
-                    # Handle different encodings
-                    if metadata.get("encoding") == "base64":
-                        # Decode base64 content
-                        actual_content = base64.b64decode(content)
-                        content_type = metadata.get(
-                            "content_type", "application/octet-stream")
-                    else:
-                        # Text content (shouldn't happen for images, but handle it)
-                        actual_content = content.encode(
-                            'utf-8') if isinstance(content, str) else content
-                        content_type = metadata.get(
-                            "content_type", "application/octet-stream")
-
-                    # Set appropriate headers for public access
-                    self.set_header("Content-Type", content_type)
-                    self.set_header("Content-Length", str(len(actual_content)))
-                    # Cache for 24 hours for public logos
-                    self.set_header("Cache-Control", "public, max-age=86400")
-                    # Allow cross-origin access
-                    self.set_header("Access-Control-Allow-Origin", "*")
-
-                    self.write(actual_content)
-                    self.finish()
-                    return
-                else:
-                    # Legacy or invalid format
-                    self.set_status(400)
-                    self.finish({"error": "Invalid file format"})
-                    return
-
-            except json.JSONDecodeError:
+            actual_content, metadata = blob
+            if metadata is None:
+                # Legacy or invalid format
                 self.set_status(400)
                 self.finish({"error": "Invalid file format"})
                 return
 
+            content_type = metadata.get(
+                "content_type", "application/octet-stream")
+
+            # Set appropriate headers for public access
+            self.set_header("Content-Type", content_type)
+            self.set_header("Content-Length", str(len(actual_content)))
+            # Cache for 24 hours for public logos
+            self.set_header("Cache-Control", "public, max-age=86400")
+            # Allow cross-origin access
+            self.set_header("Access-Control-Allow-Origin", "*")
+
+            self.write(actual_content)
+            self.finish()
+
         except Exception as e:
             logging.error(f"Error serving logo: {e}")
             self.set_status(500)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+# the storage backend is picked when cloud.storage.storage is imported;
+# never reach out to a real bucket from the tests
+os.environ["STORAGE_BACKEND"] = "memory"
+# manifest refreshes are written by the tests calling flushManifests,
+# or reading the directory
+os.environ["STORAGE_MANIFEST_FLUSH_MS"] = "600000"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+from cloud.storage import storage  # noqa: E402
+from cloud.storage.backends import MemoryBackend  # noqa: E402
+
+
+def requests(backend, fn):
+    """Call fn(), returns (its result, the backend requests it made by
+    kind)."""
+    before = dict(backend.requests)
+    result = fn()
+    return result, {kind: n - before.get(kind, 0)
+                    for kind, n in backend.requests.items()
+                    if n != before.get(kind, 0)}
+
+
+@pytest.fixture
+def backend():
+    """A fresh in-memory backend installed as the storage backend."""
+    memory = MemoryBackend()
+    storage.setBackend(memory)
+    with storage.usageCond:
+        storage.pendingUsage.clear()
+    with storage.manifestCond:
+        storage.pendingManifests.clear()
+    yield memory
+    with storage.usageCond:
+        storage.pendingUsage.clear()
+    with storage.manifestCond:
+        storage.pendingManifests.clear()
@@ -0,0 +1,62 @@
+import pytest
+
+from cloud.storage.backends import LocalBackend, MemoryBackend, SQLiteBackend
+
+KEYS = ["a/1", "a/2", "a/b/3", "ab", "b", "c/x",
+        "v2/home/a", "v2/home/a#usage", "v2/home/a/x", "v2/home/b/y/z"]
+
+
+@pytest.fixture(params=["memory", "local", "sqlite"])
+def store(request, tmp_path):
+    """Each backend with listKeys of its own, holding KEYS."""
+    if request.param == "local":
+        backend = LocalBackend(str(tmp_path / "root"))
+    elif request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "items.db"))
+    else:
+        backend = MemoryBackend()
+    for key in KEYS:
+        backend.putItem(key, key.encode('utf-8'))
+    return backend
+
+
+def listed(store, prefix, delimiter=None, startAfter=None):
+    return list(store.listKeys(prefix, delimiter, startAfter))
+
+
+def test_keys_are_listed_in_order(store):
+    assert listed(store, "") == sorted(KEYS)
+    assert listed(store, "a") == ["a/1", "a/2", "a/b/3", "ab"]
+    assert listed(store, "nothing/") == []
+
+
+def test_delimiter_rolls_keys_up_into_common_prefixes(store):
+    assert listed(store, "", "/") == ["a/", "ab", "b", "c/", "v2/"]
+    assert listed(store, "a/", "/") == ["a/1", "a/2", "a/b/"]
+    # suffixed keys sort before the children of their directory
+    assert listed(store, "v2/home/", "/") == \
+        ["v2/home/a", "v2/home/a#usage", "v2/home/a/", "v2/home/b/"]
+
+
+def test_listings_resume_after_a_key(store):
+    assert listed(store, "a/", "/", "a/1") == ["a/2", "a/b/"]
+    assert listed(store, "", None, "a/b/3") == sorted(KEYS)[3:]
+    # a start before the prefix lists the whole prefix
+    assert listed(store, "c/", "/", "a") == ["c/x"]
+
+
+def test_large_common_prefixes_are_rolled_up_across_pages(store):
+    for i in range(2500):
+        store.putItem("d/%04d" % i, b"")
+    assert listed(store, "", "/") == ["a/", "ab", "b", "c/", "d/", "v2/"]
+    assert len(listed(store, "d/", "/")) == 2500
+
+
+def test_long_local_keys_are_listed_by_their_key(tmp_path):
+    backend = LocalBackend(str(tmp_path))
+    key = "v2/home/" + "x" * 300
+    backend.putItem(key, b"long")
+    assert listed(backend, "v2/home/", "/") == [key]
+    assert backend.getItem(key) == b"long"
+    backend.deleteItem(key)
+    assert listed(backend, "") == []
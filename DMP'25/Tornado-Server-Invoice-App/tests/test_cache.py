@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import requests
+
+from cloud.storage import storage
+from cloud.storage.cache import SingleFlight
+
+READERS = 8
+
+
+def startFlight(pool, flights, fn):
+    """Run fn as the leader of a call to "k" on pool, returns its future
+    once the call is in flight."""
+    started = threading.Event()
+
+    def lead():
+        started.set()
+        return fn()
+    future = pool.submit(flights.run, "k", lead)
+    started.wait()
+    return future
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait()
+        return "value"
+    with ThreadPoolExecutor(READERS + 1) as pool:
+        leader = startFlight(pool, flights, fetch)
+        joined = [pool.submit(flights.run, "k", fetch) for _ in range(READERS)]
+        while flights.shared < READERS:
+            release.wait(0.001)
+        release.set()
+        assert [f.result() for f in joined] == ["value"] * READERS
+        assert leader.result() == "value"
+    assert len(calls) == 1
+
+
+def test_joined_callers_get_the_error():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait()
+        raise ValueError("backend down")
+    with ThreadPoolExecutor(2) as pool:
+        leader = startFlight(pool, flights, fail)
+        joined = pool.submit(flights.run, "k", lambda: "unused")
+        while flights.shared < 1:
+            release.wait(0.001)
+        release.set()
+        for future in (leader, joined):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_callers_after_a_write_start_a_new_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as pool:
+        leader = startFlight(pool, flights, lambda: release.wait() and "old")
+        flights.forget("k")
+        assert flights.run("k", lambda: "new") == "new"
+        release.set()
+        assert leader.result() == "old"
+    assert flights.shared == 0
+
+
+def test_concurrent_reads_of_a_key_cost_one_get(backend):
+    storage.writeItem("logo", "png")
+    backend.latency = 0.05
+    gate = threading.Barrier(READERS)
+
+    def read():
+        gate.wait()
+        return storage.getItem("logo")
+    with ThreadPoolExecutor(READERS) as pool:
+        values, made = requests(backend, lambda: list(
+            pool.map(lambda _: read(), range(READERS))))
+    assert values == ["png"] * READERS
+    assert made == {"get": 1}
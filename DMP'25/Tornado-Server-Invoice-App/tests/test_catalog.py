@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import requests
+
+from cloud.storage import catalog, storage
+
+USER = "ann@example.com"
+HOME = ["home", USER]
+
+
+@pytest.fixture
+def catalogDb(tmp_path):
+    """Returns a function installing a fresh sqlite catalog."""
+    def install():
+        db = catalog.Catalog("sqlite:" + str(tmp_path / "catalog.db"), 2,
+                             storage.usageOwner)
+        storage.setCatalog(db)
+        return db
+    yield install
+    storage.setCatalog(None)
+
+
+def names(entries):
+    return [name for name, _ in entries]
+
+
+def test_users_written_before_the_catalog_are_listed(backend, catalogDb):
+    assert storage.createFile(HOME + ["a"], "one")
+    assert storage.createFile(HOME + ["b"], "two")
+    catalogDb()
+    assert names(storage.listCatalog(HOME)) == ["a", "b"]
+    assert storage.createFile(HOME + ["c"], "three")
+    assert names(storage.listCatalog(HOME)) == ["a", "b", "c"]
+    assert [path[-1] for path, _ in storage.recentFiles(USER)][0] == "c"
+
+
+def test_users_saving_before_the_first_query_are_filled(backend, catalogDb):
+    for name in ("inv0", "inv1", "inv2"):
+        assert storage.createFile(HOME + [name], name)
+    catalogDb()
+    assert storage.saveFile(HOME + ["inv0"], "changed")
+    assert names(storage.listCatalog(HOME)) == ["inv0", "inv1", "inv2"]
+    # the row of the save is kept, not the older manifest entry
+    entries = dict(storage.listCatalog(HOME))
+    assert entries["inv0"]["size"] == len("changed")
+
+
+def test_users_are_filled_once(backend, catalogDb):
+    assert storage.createFile(HOME + ["a"], "one")
+    catalogDb()
+    assert names(storage.listCatalog(HOME)) == ["a"]
+    assert storage.catalogDb.filled(USER)
+    assert not storage.catalogDb.filled("bob@example.com")
+    # as another process starting on the same catalog, which reads no
+    # manifests to fill the user again
+    storage.catalogedUsers.clear()
+    listed, made = requests(backend, lambda: storage.listCatalog(HOME))
+    assert names(listed) == ["a"] and made == {}
@@ -0,0 +1,76 @@
+import io
+import os
+
+import pytest
+
+from cloud.storage import codec, storage
+
+SHEET = ("A1,B1,C1\n" * 400).encode('utf-8')
+CODECS = ["gzip"] + (["zstd"] if codec.ZSTD_AVAILABLE else [])
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_compressed_values_carry_their_codec(name):
+    packed = codec.Codec(name, minBytes=16).encode(SHEET)
+    assert packed[:codec.HEADER_SIZE] == codec.MAGIC + \
+        {"gzip": codec.GZIP, "zstd": codec.ZSTD}[name]
+    assert len(packed) < len(SHEET)
+    assert codec.decode(packed) == SHEET
+
+
+def test_small_and_incompressible_values_are_written_plain():
+    c = codec.Codec("gzip", minBytes=1024)
+    assert c.encode(b"short") == b"short"
+    noise = os.urandom(4096)
+    assert codec.Codec("gzip", minBytes=16).encode(noise) == noise
+
+
+def test_values_looking_compressed_are_stored_with_a_header():
+    value = codec.MAGIC + codec.GZIP + b"not gzip at all"
+    for c in (codec.Codec("off"), codec.Codec("gzip", minBytes=1 << 20)):
+        packed = c.encode(value)
+        assert packed == codec.MAGIC + codec.STORED + value
+        assert codec.decode(packed) == value
+
+
+def test_corrupt_values_raise_value_error():
+    with pytest.raises(ValueError):
+        codec.decode(codec.MAGIC + codec.GZIP + b"garbage")
+    with pytest.raises(ValueError):
+        codec.decode(codec.MAGIC + b"q" + b"payload")
+
+
+@pytest.mark.parametrize("name", ["off"] + CODECS)
+def test_streamed_reads_match_whole_reads(name):
+    packed = codec.Codec(name, minBytes=16).encode(SHEET)
+    stream = codec.DecodingStream(io.BytesIO(packed), len(packed))
+    chunks = []
+    while True:
+        chunk = stream.read(1000)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert b"".join(chunks) == SHEET
+
+
+@pytest.fixture
+def gzipped(backend, monkeypatch):
+    """Storage writing gzip values of 16 bytes and more."""
+    monkeypatch.setattr(storage, "compression", codec.Codec("gzip", minBytes=16))
+    return backend
+
+
+def test_items_are_compressed_on_the_way_to_the_backend(gzipped):
+    storage.writeItem("k", SHEET)
+    stored = gzipped.items["k"][0]
+    assert codec.isEncoded(stored) and len(stored) < len(SHEET)
+    storage.cache.clear()
+    assert storage.getItem("k") == SHEET.decode('utf-8')
+
+
+def test_values_written_before_compression_are_read_as_they_are(gzipped):
+    # as stored by a version without compression
+    gzipped.putItem("k", SHEET)
+    assert storage.getItem("k") == SHEET.decode('utf-8')
+    with storage.openRead("k") as reader:
+        assert reader.read() == SHEET
@@ -0,0 +1,36 @@
+import os
+
+from cloud.storage.diskcache import DiskCache
+
+VALUE = b"x" * 500
+
+
+def onDisk(root):
+    return sum(entry.stat().st_size
+               for sub in os.scandir(root) if sub.is_dir()
+               for entry in os.scandir(sub.path))
+
+
+def test_values_are_read_back_as_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path), 1 << 20)
+    value = b"v" * (1 << 16)
+    cache.put("k", value, "e1", {"a": 1})
+    data, etag, metadata = cache.get("k")
+    assert type(data) is bytes and data == value
+    assert etag == "e1" and metadata == {"a": 1}
+
+
+def test_cap_holds_across_processes(tmp_path, monkeypatch):
+    # two caches over one directory, as two worker processes
+    first = DiskCache(str(tmp_path), 8000)
+    second = DiskCache(str(tmp_path), 8000)
+    for i in range(12):
+        first.put("first%d" % i, VALUE, "e", {})
+    assert onDisk(tmp_path) <= 8000
+    monkeypatch.setattr(DiskCache, "RESCAN_SECONDS", 0)
+    for i in range(12):
+        second.put("second%d" % i, VALUE, "e", {})
+    assert onDisk(tmp_path) <= 8000
+    # the oldest files went first, whoever wrote them
+    assert first.get("first0") is None
+    assert second.get("second11") is not None
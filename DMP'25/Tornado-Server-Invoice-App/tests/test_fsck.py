@@ -0,0 +1,83 @@
+import io
+import json
+import contextlib
+
+from cloud.storage import fsck, storage
+
+HOME = ["home", "ann@example.com"]
+
+
+def run(*argv):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ok = fsck.Fsck(fsck.parseArgs(list(argv))).run()
+    lines = [json.loads(line) for line in out.getvalue().splitlines()
+             if line.startswith("{")]
+    return ok, [line for line in lines if "issue" in line], lines[-1]
+
+
+def plant(path, data):
+    """Write a file object its directory does not list."""
+    storage.writeItem(storage.pathToString(path), json.dumps(
+        {"data": data, "path": path, "type": "file"}))
+
+
+def test_clean_tree(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "one")
+    assert storage.createBlob(["logos", "shared.png"], b"png", {})
+    ok, issues, _ = run()
+    assert ok and issues == []
+
+
+def test_orphan_in_a_home_directory(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "one")
+    plant(HOME + ["sheets", "orphan"], "zzz")
+    ok, issues, _ = run()
+    assert not ok
+    assert [(i["issue"], i["path"]) for i in issues] == \
+        [("orphan", HOME + ["sheets", "orphan"])]
+    ok, _, summary = run("--repair", "--grace", "0")
+    assert summary["repaired"] == {"orphan": 1}
+    assert storage.getItem(storage.pathToString(HOME + ["sheets", "orphan"])) is None
+    assert storage.fetchFile(HOME + ["sheets", "a"]) == "one"
+
+
+def test_dangling_entry(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "one")
+    assert storage.createFile(HOME + ["sheets", "b"], "two")
+    backend.deleteItem(storage.pathToString(HOME + ["sheets", "a"]))
+    ok, issues, _ = run()
+    assert [(i["issue"], i["path"]) for i in issues] == \
+        [("dangling", HOME + ["sheets", "a"])]
+
+
+def test_dangling_entry_of_a_directory_without_keys(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "one")
+    backend.deleteItem(storage.pathToString(HOME + ["sheets", "a"]))
+    ok, issues, _ = run()
+    assert [(i["issue"], i["path"]) for i in issues] == \
+        [("dangling", HOME + ["sheets", "a"])]
+
+
+def test_orphan_in_a_top_level_directory(backend):
+    assert storage.createBlob(["logos", "shared.png"], b"png", {})
+    plant(["logos", "orphan.png"], "zzz")
+    ok, issues, _ = run()
+    assert not ok
+    assert [(i["issue"], i["path"]) for i in issues] == \
+        [("orphan", ["logos", "orphan.png"])]
+    ok, _, summary = run("--repair", "--grace", "0")
+    assert summary["repaired"] == {"orphan": 1}
+    assert storage.getItem(storage.pathToString(["logos", "orphan.png"])) is None
+    assert storage.getBlob(["logos", "shared.png"])[0] == b"png"
+    ok, issues, _ = run()
+    assert ok and issues == []
+
+
+def test_top_level_directories_are_not_orphans(backend):
+    assert storage.createFile(HOME + ["a"], "one")
+    assert storage.createDir(["home", "bob@example.com"])
+    assert storage.createDir(["logos"])
+    assert storage.createDir(["logos", "empty"])
+    ok, issues, _ = run()
+    assert ok and issues == []
@@ -0,0 +1,142 @@
+import os
+import json
+
+import pytest
+
+from cloud.storage import journal, storage
+from cloud.storage.backends import StorageError
+
+HOME = ["home", "ann@example.com"]
+
+
+class Writes:
+    """A journal write function recording the saves it is given, or
+    failing them all while fail is set."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.saves = []
+
+    def __call__(self, path, data):
+        if self.fail:
+            return False
+        self.saves.append((path, data))
+        return True
+
+
+def crash(root, *saves):
+    """Journal saves, (key, data), whose writes never land, and stop
+    as a crashing process would leave them."""
+    j = journal.Journal(root, Writes(fail=True), delay=600)
+    for key, data in saves:
+        j.append(key, [key], data)
+    j.close()
+
+
+def segments(root):
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if name.endswith(journal.SUFFIX)]
+
+
+def test_replay_queues_the_latest_save_of_each_key(tmp_path):
+    crash(str(tmp_path), ("a", "one"), ("b", "two"), ("a", "three"))
+    writes = Writes()
+    j = journal.Journal(str(tmp_path), writes, delay=600)
+    try:
+        assert j.stats()["replayed"] == 2
+        assert json.loads(j.lookup("a"))["data"] == "three"
+        assert j.flush()
+        assert sorted(writes.saves) == [(["a"], "three"), (["b"], "two")]
+    finally:
+        j.close()
+    # written, so nothing is replayed again
+    j = journal.Journal(str(tmp_path), Writes(), delay=600)
+    j.close()
+    assert j.stats()["replayed"] == 0
+
+
+@pytest.mark.parametrize("tail", [
+    # a torn append: the header made it, the payload did not
+    journal.HEADER.pack(100, 0) + b'{"seq": 9',
+    # a whole record with a bad checksum
+    journal.HEADER.pack(2, 0) + b"{}",
+])
+def test_replay_stops_at_a_torn_record(tmp_path, tail):
+    crash(str(tmp_path), ("a", "one"), ("b", "two"))
+    (fname,) = segments(str(tmp_path))
+    size = os.path.getsize(fname)
+    with open(fname, "ab") as f:
+        f.write(tail)
+    writes = Writes()
+    j = journal.Journal(str(tmp_path), writes, delay=600)
+    try:
+        assert j.stats()["replayed"] == 2
+        assert os.path.getsize(fname) == size
+        # appends after the truncated tail are replayed in turn
+        j.append("c", ["c"], "three")
+    finally:
+        j.close()
+    assert sorted(writes.saves) == [(["a"], "one"), (["b"], "two"),
+                                    (["c"], "three")]
+
+
+def test_supersede_writes_the_queued_save_and_keeps_it_from_replay(tmp_path):
+    writes = Writes()
+    j = journal.Journal(str(tmp_path), writes, delay=600)
+    j.append("a", ["a"], "one")
+    j.supersede("a")
+    assert writes.saves == [(["a"], "one")]
+    assert not j.queued("a") and j.lookup("a") is None
+    # crash with the save and its drop record still in the segment
+    j.write = Writes(fail=True)
+    j.close()
+    j = journal.Journal(str(tmp_path), Writes(), delay=600)
+    j.close()
+    assert j.stats()["replayed"] == 0
+
+
+def test_failed_supersede_keeps_the_save_queued(tmp_path):
+    writes = Writes()
+    j = journal.Journal(str(tmp_path), writes, delay=600)
+    try:
+        j.append("a", ["a"], "one")
+        writes.fail = True
+        with pytest.raises(StorageError):
+            j.supersede("a")
+        assert j.queued("a")
+    finally:
+        writes.fail = False
+        j.close()
+    assert writes.saves == [(["a"], "one")]
+
+
+@pytest.fixture
+def journaled(backend, tmp_path, monkeypatch):
+    """The storage journal in tmp_path, flushed only when asked to."""
+    j = journal.Journal(str(tmp_path), storage.upsertFile, delay=600)
+    monkeypatch.setattr(storage, "journal", j)
+    yield j
+    j.close()
+
+
+def test_saves_of_a_known_file_are_journaled(backend, journaled):
+    path = HOME + ["a"]
+    assert storage.createFile(path, "one")
+    assert storage.saveFile(path, "two")
+    assert storage.saveFile(path, "three")
+    assert journaled.queued(storage.pathToString(path))
+    # read back from the journal before it is written
+    assert storage.fetchFile(path) == "three"
+    assert journaled.flush()
+    assert not journaled.queued(storage.pathToString(path))
+    assert json.loads(backend.items[storage.pathToString(path)][0])["data"] == "three"
+
+
+def test_delete_of_a_journaled_file_keeps_it_deleted(backend, journaled):
+    path = HOME + ["a"]
+    assert storage.createFile(path, "one")
+    assert storage.saveFile(path, "two")
+    assert storage.deleteFile(path)
+    assert journaled.flush()
+    assert storage.fetchFile(path) is None
+    assert storage.pathToString(path) not in backend.items
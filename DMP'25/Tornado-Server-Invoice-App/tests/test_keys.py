@@ -0,0 +1,70 @@
+import pytest
+
+from cloud.storage import storage
+
+HOME = ["home", "ann@example.com"]
+LEGACY = storage.legacyKey(HOME + ["inv 1"])
+
+
+def test_v2_keys_percent_encode_every_element():
+    path = ["home", "a@b.c", "q1/q2#draft"]
+    key = storage.v2Key(path)
+    assert key == "v2/home/a%40b.c/q1%2Fq2%23draft"
+    assert storage.keyToPath(key, 0) == (path, "")
+    assert storage.keyToPath(key + "#history", 0) == (path, "#history")
+
+
+def test_sharded_v2_keys_keep_a_user_under_one_prefix():
+    first = storage.v2Key(HOME + ["a"], 16)
+    second = storage.v2Key(HOME + ["b", "c"], 16)
+    shard = first.split("/")[1]
+    assert second.startswith("v2/" + shard + "/home/ann%40example.com/")
+    assert storage.keyToPath(second, 16) == (HOME + ["b", "c"], "")
+    # the children of a top level directory are under every shard
+    assert len(storage.layoutPrefixes(["home"], "v2", 16)) == 16
+
+
+def test_json_keys_still_parse():
+    assert storage.keyToPath(LEGACY + "#usage", 0) == (HOME + ["inv 1"], "#usage")
+    assert storage.keyToPath("not a key", 0) == (None, None)
+
+
+@pytest.fixture
+def v2(backend, monkeypatch):
+    """Switches storage to v2 keys, falling back to json ones."""
+    def switch():
+        monkeypatch.setattr(storage, "STORAGE_KEY_LAYOUT", "v2")
+        monkeypatch.setattr(storage, "STORAGE_KEY_FALLBACK", True)
+        # as a process starting with the new layout
+        storage.setBackend(backend)
+    return switch
+
+
+def test_v2_children_are_listed_with_a_delimiter(backend, v2):
+    v2()
+    assert storage.createFile(HOME + ["a"], "one")
+    assert storage.createFile(HOME + ["b c"], "two")
+    assert storage.createDir(HOME + ["logos"])
+    assert storage.createFile(HOME + ["logos", "x.png"], "three")
+    assert sorted(storage.listChildren(HOME)) == ["a", "b c", "logos"]
+    assert all(key.startswith("v2/") for key in backend.items)
+
+
+def test_json_tree_reads_through_the_fallback(backend, v2):
+    assert storage.createFile(HOME + ["inv 1"], "one")
+    v2()
+    assert storage.fetchFile(HOME + ["inv 1"]) == "one"
+    assert "inv 1" in storage.listChildren(HOME)
+    # the json key still counts for creates
+    assert not storage.createFile(HOME + ["inv 1"], "two")
+
+
+def test_json_tree_moves_over_as_it_is_rewritten(backend, v2):
+    assert storage.createFile(HOME + ["inv 1"], "one")
+    v2()
+    assert storage.upsertFile(HOME + ["inv 1"], "two")
+    assert storage.v2Key(HOME + ["inv 1"]) in backend.items
+    assert storage.fetchFile(HOME + ["inv 1"]) == "two"
+    assert storage.deleteFile(HOME + ["inv 1"])
+    assert LEGACY not in backend.items
+    assert storage.fetchFile(HOME + ["inv 1"]) is None
@@ -0,0 +1,74 @@
+import json
+
+from cloud.storage import migrate, storage
+from cloud.storage.backends import MemoryBackend, StorageError
+
+KEYS = [storage.legacyKey(["home", "ann@example.com", "inv%d" % i])
+        for i in range(10)]
+
+
+class FailingBackend(MemoryBackend):
+    """Fails the puts of the keys in failing."""
+
+    def __init__(self, failing=()):
+        super().__init__()
+        self.failing = set(failing)
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        if key in self.failing:
+            raise StorageError(f"put {key}: refused")
+        return super().putItem(key, data, metadata, ifNoneMatch, ifMatch)
+
+
+def source():
+    backend = MemoryBackend()
+    for i, key in enumerate(KEYS):
+        backend.putItem(key, b"value %d" % i)
+    return backend
+
+
+def migration(src, dest, checkpoint, *argv):
+    args = migrate.parseArgs(["--source", "a", "--dest", "b", "--workers", "2",
+                              "--checkpoint", str(checkpoint)] + list(argv))
+    return migrate.Migration(src, dest, args)
+
+
+def test_failed_keys_are_retried_on_resume(tmp_path):
+    ckpt = tmp_path / "migrate.ckpt"
+    src = source()
+    dest = FailingBackend([KEYS[3], KEYS[7]])
+    assert not migration(src, dest, ckpt).run()
+    state = json.loads(ckpt.read_text())
+    assert sorted(state["failed"]) == [KEYS[3], KEYS[7]]
+    assert state["copied"] == 8
+
+    dest.failing.clear()
+    puts = dest.requests.get("put", 0)
+    assert migration(src, dest, ckpt).run()
+    # only the failed keys are copied again
+    assert dest.requests["put"] - puts == 2
+    assert sorted(dest.items) == sorted(KEYS)
+    assert json.loads(ckpt.read_text())["failed"] == []
+
+
+def test_resume_continues_after_the_saved_key(tmp_path):
+    ckpt = tmp_path / "migrate.ckpt"
+    # as saved by a run stopped partway through the listing
+    ckpt.write_text(json.dumps({"phase": 0, "after": KEYS[5], "failed": [],
+                                "copied": 6, "bytes": 42}))
+    dest = MemoryBackend()
+    assert migration(source(), dest, ckpt).run()
+    assert sorted(dest.items) == sorted(KEYS)[6:]
+    state = json.loads(ckpt.read_text())
+    assert state["copied"] == 10 and state["phase"] == 1
+
+
+def test_keys_are_moved_to_the_new_layout(tmp_path):
+    dest = MemoryBackend()
+    assert migration(source(), dest, tmp_path / "ckpt",
+                     "--to-layout", "v2", "--verify").run()
+    assert sorted(dest.items) == sorted(
+        storage.v2Key(storage.keyToPath(key, 0)[0]) for key in KEYS)
+    assert dest.getItem(storage.v2Key(["home", "ann@example.com", "inv4"])) \
+        == b"value 4"
@@ -0,0 +1,86 @@
+import json
+import itertools
+
+import pytest
+
+from conftest import requests
+
+from cloud.storage import storage
+from cloud.storage.negcache import BloomFilter, BloomFilters, NegativeCache
+
+HOME = ["home", "ann@example.com"]
+
+
+def test_bloom_filters_have_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    keys = ["key%d" % i for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    others = sum(("other%d" % i) in bloom for i in range(10000))
+    assert others < 300
+
+
+def test_a_miss_read_before_a_write_is_not_remembered():
+    negatives = NegativeCache(100, 60)
+    token = negatives.token()
+    negatives.discard("k")   # a write landing during the read
+    negatives.add("k", token)
+    assert not negatives.missing("k")
+    negatives.add("k", negatives.token())
+    assert negatives.missing("k")
+
+
+@pytest.fixture
+def bloomed(backend, monkeypatch):
+    """Bloom filters of the home directories, listed again once
+    refresh is set to 0."""
+    blooms = BloomFilters(
+        ["home/*"],
+        lambda path: itertools.chain.from_iterable(
+            storage.backend.listKeys(prefix)
+            for prefix in storage.childPrefixes(path)),
+        lambda key: storage.keyToPath(key)[0])
+    monkeypatch.setattr(storage, "blooms", blooms)
+    monkeypatch.setattr(storage, "negatives", None)
+    return blooms
+
+
+def elsewhere(backend, path, data):
+    """Write a file as another process would, unseen by this one."""
+    backend.putItem(storage.pathToString(path), json.dumps(
+        {"data": data, "path": path, "type": "file"}).encode('utf-8'),
+        ifNoneMatch=True)
+
+
+def test_probes_of_new_names_skip_the_backend(backend, bloomed):
+    assert storage.createFile(HOME + ["a"], "one")
+    assert storage.fileExists(HOME + ["a"])
+    exists, made = requests(backend, lambda: storage.fileExists(HOME + ["b"]))
+    assert not exists and "get" not in made
+    # written by this process, never reported missing
+    assert storage.createFile(HOME + ["b"], "two")
+    assert storage.fileExists(HOME + ["b"])
+
+
+def test_writes_of_other_processes_are_caught_by_the_create(backend, bloomed):
+    assert storage.createFile(HOME + ["a"], "one")
+    assert not storage.fileExists(HOME + ["b"])
+    elsewhere(backend, HOME + ["b"], "theirs")
+    # the filter only knows this process's writes until it is rebuilt,
+    # but the create is conditional and keeps theirs
+    assert not storage.fileExists(HOME + ["b"])
+    assert storage.fileExists(HOME + ["b"], revalidate=True)
+    assert not storage.createFile(HOME + ["b"], "mine")
+    assert storage.fetchFile(HOME + ["b"]) == "theirs"
+    # a rebuilt filter lists it
+    bloomed.refresh = 0
+    assert storage.fileExists(HOME + ["b"])
+
+
+def test_negative_entries_are_dropped_by_a_write(backend):
+    assert storage.getItem("k") is None
+    _, made = requests(backend, lambda: storage.getItem("k"))
+    assert made == {}
+    storage.writeItem("k", "one")
+    assert storage.getItem("k") == "one"
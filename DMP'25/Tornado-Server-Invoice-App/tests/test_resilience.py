@@ -0,0 +1,77 @@
+import pytest
+
+from cloud.storage.backends import (
+    MemoryBackend, PreconditionFailed, TransientError)
+from cloud.storage.resilience import ResilientBackend
+
+
+class DroppedResponses(MemoryBackend):
+    """Applies the next `drops` puts and then raises, as if their
+    responses were lost; ambiguous=False fails them before applying."""
+
+    def __init__(self, drops=1, ambiguous=True):
+        super().__init__()
+        self.drops = drops
+        self.ambiguous = ambiguous
+
+    def putItem(self, key, data, metadata=None, ifNoneMatch=False,
+                ifMatch=None):
+        if self.drops > 0:
+            self.drops -= 1
+            if not self.ambiguous:
+                raise TransientError(f"put {key}: SlowDown")
+            super().putItem(key, data, metadata, ifNoneMatch, ifMatch)
+            raise TransientError(f"put {key}: connection reset",
+                                 ambiguous=True)
+        return super().putItem(key, data, metadata, ifNoneMatch, ifMatch)
+
+
+def resilient(inner):
+    return ResilientBackend(inner, attempts=3, baseDelay=0, maxDelay=0)
+
+
+def test_ambiguous_conditional_put_is_not_retried():
+    inner = DroppedResponses()
+    backend = resilient(inner)
+    # a retry would find the first attempt's value and report a false
+    # PreconditionFailed
+    with pytest.raises(TransientError) as raised:
+        backend.putItem("k", b"one", ifNoneMatch=True)
+    assert raised.value.ambiguous
+    assert inner.requests["put"] == 1
+    assert inner.getItem("k") == b"one"
+    assert backend.stats()["retries"] == 0
+
+
+def test_ambiguous_if_match_put_is_not_retried():
+    inner = DroppedResponses(drops=0)
+    backend = resilient(inner)
+    etag = backend.putItem("k", b"one")
+    inner.drops = 1
+    with pytest.raises(TransientError):
+        backend.putItem("k", b"two", ifMatch=etag)
+    assert inner.requests["put"] == 2
+
+
+def test_unconditional_put_is_retried():
+    inner = DroppedResponses()
+    backend = resilient(inner)
+    assert backend.putItem("k", b"one") is not None
+    assert inner.requests["put"] == 2 and backend.stats()["retries"] == 1
+
+
+def test_conditional_put_that_never_applied_is_retried():
+    inner = DroppedResponses(ambiguous=False)
+    backend = resilient(inner)
+    assert backend.putItem("k", b"one", ifNoneMatch=True) is not None
+    assert backend.stats()["retries"] == 1
+    with pytest.raises(PreconditionFailed):
+        backend.putItem("k", b"two", ifNoneMatch=True)
+
+
+def test_retries_stop_at_the_attempt_limit():
+    inner = DroppedResponses(drops=5, ambiguous=False)
+    backend = resilient(inner)
+    with pytest.raises(TransientError):
+        backend.putItem("k", b"one")
+    assert backend.stats()["attempts"] == 3 and backend.stats()["failures"] == 1
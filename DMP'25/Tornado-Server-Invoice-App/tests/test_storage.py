@@ -0,0 +1,192 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import requests
+
+from cloud.storage import storage
+
+HOME = ["home", "ann@example.com"]
+
+
+def manifest(path):
+    return storage.getFile(path).manifest
+
+
+def test_put_if_absent_only_creates(backend):
+    assert storage.putIfAbsent("k", "one") is not None
+    assert storage.putIfAbsent("k", "two") is None
+    assert storage.getItem("k") == "one"
+
+
+def test_put_if_match_needs_the_current_etag(backend):
+    etag = storage.putIfAbsent("k", "one")
+    newetag = storage.putIfMatch("k", "two", etag)
+    assert newetag is not None
+    assert storage.putIfMatch("k", "three", etag) is None
+    assert storage.getItem("k") == "two"
+    assert storage.putIfMatch("k", "three", newetag) is not None
+
+
+def test_create_file_fails_when_it_exists(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.createFile(path, "one")
+    assert not storage.createFile(path, "two")
+    assert storage.fetchFile(path) == "one"
+
+
+def test_upsert_creates_then_updates(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    assert storage.upsertFile(path, "two")
+    assert storage.fetchFile(path) == "two"
+    assert storage.getFile(path[:-1]).names == ["a"]
+
+
+def test_upsert_of_a_file_written_elsewhere(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.createFile(path, "one")
+    storage.knownEtags.clear()
+    assert storage.upsertFile(path, "longer")
+    assert storage.fetchFile(path) == "longer"
+    assert manifest(path[:-1])["a"]["size"] == 6
+
+
+def test_save_of_a_known_file_costs_one_put(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    # a new size also updates the usage record, see test_usage
+    ok, made = requests(backend, lambda: storage.upsertFile(path, "two"))
+    assert ok
+    assert made == {"put": 1}
+    # the file, its directory and the usage record, two puts with the
+    # usage changes queued (STORAGE_USAGE_FLUSH_MS)
+    ok, made = requests(backend, lambda: storage.createFile(path[:-1] + ["b"], "new"))
+    assert ok
+    assert made == {"put": 3}
+
+
+def test_saves_share_one_manifest_refresh(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    for data in ("two", "three", "four!"):
+        assert storage.upsertFile(path, data)
+    key = storage.pathToString(path[:-1])
+    assert json.loads(backend.getItem(key))["manifest"]["a"]["size"] == 3
+    ok, made = requests(backend, storage.flushManifests)
+    assert ok and made == {"put": 1}
+    assert json.loads(backend.getItem(key))["manifest"]["a"]["size"] == 5
+
+
+def test_queued_refresh_keeps_a_deleted_file_deleted(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    assert storage.upsertFile(path, "two!")
+    # deleted by another process before the refresh is written
+    assert storage.createFile(path[:-1] + ["b"], "x")
+    storage.pendingManifests[tuple(path[:-1])]["a"] = (4, "9999")
+    head = json.loads(backend.getItem(storage.pathToString(path[:-1])))
+    head["data"] = json.dumps(["b"])
+    del head["manifest"]["a"]
+    backend.putItem(storage.pathToString(path[:-1]), json.dumps(head).encode())
+    assert storage.flushManifests()
+    assert set(manifest(path[:-1])) == {"b"}
+
+
+def test_directory_write_retries_after_another_writer(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.createFile(path, "one")
+    # the directory changes behind the cached copy
+    key = storage.pathToString(path[:-1])
+    head = json.loads(storage.getItem(key))
+    head["manifest"]["a"]["metadata"] = {"tag": "x"}
+    backend.putItem(key, json.dumps(head).encode('utf-8'))
+    assert storage.createFile(path[:-1] + ["b"], "two")
+    entries = manifest(path[:-1])
+    assert set(entries) == {"a", "b"}
+    assert entries["a"]["metadata"] == {"tag": "x"}
+
+
+def test_update_keeps_manifest_current(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.createFile(path, "12345", {"title": "A"})
+    created = manifest(path[:-1])["a"]
+    assert storage.updateFile(path, "1234567890")
+    entry = manifest(path[:-1])["a"]
+    assert entry["size"] == 10
+    assert entry["modified_at"] >= created["modified_at"]
+    assert entry["created_at"] == created["created_at"]
+    assert entry["metadata"] == {"title": "A"}
+
+
+def test_upsert_keeps_manifest_current(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "12345")
+    assert storage.upsertFile(path, "1234567")
+    assert storage.upsertFile(path, "123456789")
+    assert manifest(path[:-1])["a"]["size"] == 9
+
+
+def test_batch_update_keeps_manifest_current(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.createFile(path, "12345")
+    batch = storage.Batch()
+    batch.updateFile(path, "12345678")
+    assert batch.commit()
+    assert manifest(path[:-1])["a"]["size"] == 8
+
+
+def test_segmented_directory_keeps_every_entry(backend, monkeypatch):
+    monkeypatch.setattr(storage, "DIR_SEGMENT_SIZE", 4)
+    path = HOME + ["many"]
+    for i in range(20):
+        assert storage.createFile(path + [f"f{i}"], "x" * i)
+    assert storage.getFileRaw(path).get("segmented")
+    assert storage.updateFile(path + ["f3"], "y" * 30)
+    assert storage.deleteFile(path + ["f4"])
+    entries = dict(storage.iterDir(path))
+    assert len(entries) == 19 and "f4" not in entries
+    assert entries["f3"]["size"] == 30
+
+
+def test_segmented_directory_keeps_concurrent_creates(backend, monkeypatch):
+    monkeypatch.setattr(storage, "DIR_SEGMENT_SIZE", 8)
+    path = ["home", "users"]
+    for i in range(20):
+        assert storage.createFile(path + [f"u{i}"], "x")
+    assert storage.getFileRaw(path).get("segmented")
+    # slow enough for the writers of one segment to interleave
+    backend.latency, backend.jitter = 0.002, 0.002
+    with ThreadPoolExecutor(40) as pool:
+        created = list(pool.map(
+            lambda i: storage.createFile(path + [f"u{i}"], "x"), range(20, 60)))
+    assert all(created)
+    assert sorted(name for name, _ in storage.iterDir(path)) == \
+        sorted(f"u{i}" for i in range(60))
+
+
+def test_missing_key_is_remembered_until_written(backend):
+    if storage.negatives is None:
+        return
+    assert storage.getItem("k") is None
+    _, made = requests(backend, lambda: storage.getItem("k"))
+    assert made == {}
+    assert storage.putItem("k", "v")
+    assert storage.getItem("k") == "v"
+
+
+def test_revalidating_read_skips_the_negative_cache(backend):
+    if storage.negatives is None:
+        return
+    assert storage.getItem("k") is None
+    # written by another process
+    backend.putItem("k", b"v")
+    assert storage.getItem("k", revalidate=True) == "v"
+
+
+def test_file_exists_after_delete(backend):
+    path = HOME + ["sheets", "a"]
+    assert not storage.fileExists(path)
+    assert storage.createFile(path, "one")
+    assert storage.fileExists(path)
+    assert storage.deleteFile(path)
+    assert not storage.fileExists(path)
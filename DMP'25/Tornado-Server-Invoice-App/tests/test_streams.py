@@ -0,0 +1,122 @@
+import pytest
+
+from cloud.storage import codec, storage
+from cloud.storage.backends import (
+    ClientError, PreconditionFailed, S3Backend, computeEtag)
+
+PART = 5 * 1024 * 1024
+
+
+def written(chunks, key="k", **kwargs):
+    with storage.openWrite(key, **kwargs) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer
+
+
+def readBack(key="k"):
+    with storage.openRead(key) as reader:
+        return b"".join(reader), reader.metadata
+
+
+def test_streamed_values_round_trip(backend):
+    chunks = [bytes([i]) * 1000 for i in range(10)]
+    writer = written(chunks, metadata={"type": "blob"})
+    assert writer.size == 10000
+    assert writer.etag == backend.items["k"][1]
+    assert readBack() == (b"".join(chunks), {"type": "blob"})
+    assert storage.openRead("missing") is None
+
+
+def test_streamed_values_looking_compressed_read_back_unchanged(backend):
+    # the magic arrives split across writes
+    value = codec.MAGIC + codec.GZIP + b"raw bytes"
+    written([value[:2], value[2:]])
+    assert backend.items["k"][0] == codec.MAGIC + codec.STORED + value
+    assert readBack()[0] == value
+    assert storage.getItem("k") == value.decode('utf-8')
+
+
+def test_streamed_reads_decode_compressed_values(backend, monkeypatch):
+    monkeypatch.setattr(storage, "compression", codec.Codec("gzip", minBytes=16))
+    value = b"line of a sheet\n" * 1000
+    storage.writeItem("k", value)
+    assert codec.isEncoded(backend.items["k"][0])
+    assert readBack()[0] == value
+
+
+def test_conditional_streamed_writes(backend):
+    written([b"one"], ifNoneMatch=True)
+    with pytest.raises(PreconditionFailed):
+        written([b"two"], ifNoneMatch=True)
+    with pytest.raises(PreconditionFailed):
+        written([b"two"], ifMatch=computeEtag(b"other"))
+    written([b"two"], ifMatch=computeEtag(b"one"))
+    assert readBack()[0] == b"two"
+
+
+class FakeS3:
+    """The S3 client calls of S3Writer, recorded; complete fails with
+    PreconditionFailed when fail is set."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def put_object(self, **args):
+        self.calls.append(("put", len(args["Body"])))
+        return {"ETag": computeEtag(args["Body"])}
+
+    def create_multipart_upload(self, **args):
+        self.calls.append(("create",))
+        return {"UploadId": "u1"}
+
+    def upload_part(self, **args):
+        self.calls.append(("part", args["PartNumber"], len(args["Body"])))
+        return {"ETag": f'"part{args["PartNumber"]}"'}
+
+    def complete_multipart_upload(self, **args):
+        self.calls.append(("complete", len(args["MultipartUpload"]["Parts"]),
+                           args.get("IfNoneMatch")))
+        if self.fail:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}},
+                              "CompleteMultipartUpload")
+        return {"ETag": '"multi-2"'}
+
+    def abort_multipart_upload(self, **args):
+        self.calls.append(("abort",))
+
+
+def s3Write(client, sizes, **kwargs):
+    writer = S3Backend("bucket", client=client,
+                       multipartBytes=PART).openWrite("k", **kwargs)
+    for size in sizes:
+        writer.write(b"x" * size)
+    return writer.commit()
+
+
+def test_values_within_one_part_are_a_single_put():
+    client = FakeS3()
+    s3Write(client, [PART - 1])
+    assert client.calls == [("put", PART - 1)]
+
+
+def test_values_outgrowing_one_part_become_a_multipart_upload():
+    client = FakeS3()
+    writer = S3Backend("bucket", client=client,
+                       multipartBytes=PART).openWrite("k", ifNoneMatch=True)
+    writer.write(b"x" * (PART - 1))
+    assert client.calls == []
+    # a full part is sent as soon as it is written
+    writer.write(b"x" * 2)
+    assert client.calls == [("create",), ("part", 1, PART)]
+    assert writer.commit() == '"multi-2"'
+    assert client.calls[2:] == [("part", 2, 1), ("complete", 2, "*")]
+
+
+def test_failed_multipart_condition_aborts_the_upload():
+    pytest.importorskip("botocore")
+    client = FakeS3(fail=True)
+    with pytest.raises(PreconditionFailed):
+        s3Write(client, [PART + 1], ifNoneMatch=True)
+    assert client.calls[-1] == ("abort",)
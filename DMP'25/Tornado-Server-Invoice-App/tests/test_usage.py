@@ -0,0 +1,91 @@
+import json
+
+from conftest import requests
+
+from cloud.storage import storage
+
+USER = "ann@example.com"
+HOME = ["home", USER]
+
+
+def stored():
+    data = storage.getItem(storage.usageKey(USER), revalidate=True)
+    return json.loads(data) if data is not None else None
+
+
+def test_usage_counts_creates_updates_and_deletes(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "12345")
+    assert storage.createBlob(HOME + ["logos", "l.png"], b"x" * 100, {})
+    assert storage.updateFile(HOME + ["sheets", "a"], "1234567890")
+    assert storage.upsertFile(HOME + ["sheets", "b"], "123")
+    assert storage.deleteFile(HOME + ["sheets", "b"])
+    usage = storage.getUsage(USER)
+    assert (usage["bytes"], usage["objects"]) == (110, 2)
+    assert usage["dirs"] == {"sheets": {"bytes": 10, "objects": 1},
+                             "logos": {"bytes": 100, "objects": 1}}
+
+
+def test_usage_is_written_before_the_write_returns(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "12345")
+    assert stored()["bytes"] == 5
+    assert storage.upsertFile(HOME + ["sheets", "a"], "1234567")
+    assert stored()["bytes"] == 7
+
+
+def test_save_writes_usage_only_when_the_size_changes(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    _, made = requests(backend, lambda: storage.upsertFile(path, "two"))
+    assert made == {"put": 1}
+    # the file and the usage record, from the item cache
+    _, made = requests(backend, lambda: storage.upsertFile(path, "three"))
+    assert made == {"put": 2}
+
+
+def test_queued_usage_is_written_in_the_background(backend, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_USAGE_FLUSH_MS", 600000)
+    assert storage.createFile(HOME + ["sheets", "a"], "12345")
+    assert storage.upsertFile(HOME + ["sheets", "a"], "1234567")
+    assert stored() is None
+    assert storage.getUsage(USER)["bytes"] == 7
+    assert storage.flushUsage()
+    assert stored()["bytes"] == 7
+
+
+def test_queued_saves_make_no_usage_requests(backend, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_USAGE_FLUSH_MS", 600000)
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "one")
+    _, made = requests(backend, lambda: storage.upsertFile(path, "three"))
+    assert made == {"put": 1}
+    # the queued changes of all the saves are one update
+    _, made = requests(backend, storage.flushUsage)
+    assert made.get("put") == 1
+
+
+def test_recompute_agrees_after_updates(backend):
+    path = HOME + ["sheets", "a"]
+    assert storage.upsertFile(path, "12345")
+    assert storage.upsertFile(path, "123456789")
+    assert storage.createFile(HOME + ["b"], "12")
+    assert storage.flushUsage()
+    record = storage.recomputeUsage(USER)
+    assert (record["bytes"], record["objects"]) == (11, 2)
+    assert storage.getUsage(USER)["bytes"] == 11
+
+
+def test_quota(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "x" * 50)
+    assert storage.setQuota(USER, maxBytes=100)
+    assert storage.checkQuota(USER, 50)
+    assert not storage.checkQuota(USER, 51)
+    assert storage.setQuota(USER)
+    assert storage.checkQuota(USER, 10 ** 9)
+
+
+def test_deleting_the_home_directory_drops_the_record(backend):
+    assert storage.createFile(HOME + ["sheets", "a"], "12345")
+    assert storage.flushUsage()
+    assert storage.deleteDir(HOME)
+    assert storage.flushUsage()
+    assert stored() is None
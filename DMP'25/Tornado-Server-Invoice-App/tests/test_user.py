@@ -0,0 +1,41 @@
+import json
+
+from conftest import requests
+
+from cloud.authenticate import user
+from cloud.storage import storage
+
+EMAIL = "ann@example.com"
+
+
+def register_elsewhere(backend, email):
+    """Write a user the way another process would, behind this
+    process's caches."""
+    path = user.get_user_path(email)
+    data = {"data": user.User(email, "pw").get_data(), "path": path,
+            "type": "file"}
+    backend.putItem(storage.pathToString(path), json.dumps(data).encode())
+
+
+def test_create_user_reports_the_result(backend):
+    assert user.create_user(EMAIL, "pw")
+    assert user.user_exists(EMAIL)
+    assert not user.create_user(EMAIL, "other")
+    assert user.authenticate_user(EMAIL, "pw")
+
+
+def test_probe_of_a_new_user_is_answered_locally(backend):
+    if storage.negatives is None:
+        return
+    assert not user.user_exists(EMAIL)
+    exists, made = requests(backend, lambda: user.user_exists(EMAIL))
+    assert not exists and made == {}
+
+
+def test_create_settles_a_user_registered_elsewhere(backend):
+    # remembered as missing by the probe
+    assert not user.user_exists(EMAIL)
+    register_elsewhere(backend, EMAIL)
+    assert not user.create_user(EMAIL, "pw")
+    assert user.user_exists(EMAIL, revalidate=True)
+    assert user.authenticate_user(EMAIL, "pw")
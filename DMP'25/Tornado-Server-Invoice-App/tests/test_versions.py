@@ -0,0 +1,75 @@
+import pytest
+
+from cloud.storage import storage, versions
+
+PATH = ["home", "ann@example.com", "inv"]
+
+
+def sheet(n):
+    """A sheet whose version n changes one of its forty lines."""
+    return "".join(f"row {i}: {n if i == n % 40 else 0}\n" for i in range(40))
+
+
+def test_deltas_turn_one_version_into_the_next():
+    old, new = sheet(1), sheet(2) + "total\n"
+    assert versions.applyDelta(old, versions.makeDelta(old, new)) == new
+    assert versions.applyDelta(old, versions.makeDelta(old, "")) == ""
+
+
+def test_rewrites_start_a_new_run():
+    history, closed, _ = versions.addVersion(None, sheet(1), "t1", 10, 5)
+    history, closed, _ = versions.addVersion(history, sheet(2), "t2", 10, 5)
+    assert closed is None and len(history["deltas"]) == 1
+    history, closed, _ = versions.addVersion(history, "something else\n",
+                                             "t3", 10, 5)
+    first, run = closed
+    assert first == 1 and run["base"] == sheet(1) and len(run["deltas"]) == 1
+    assert history["run"] == 3 and history["deltas"] == []
+    assert versions.addVersion(history, "something else\n", "t4", 10, 5) is None
+
+
+@pytest.fixture
+def versioned(backend, monkeypatch):
+    """Storage keeping at least 4 versions, in runs of 2 deltas."""
+    monkeypatch.setattr(storage, "STORAGE_VERSIONS", 4)
+    monkeypatch.setattr(storage, "STORAGE_VERSION_DELTAS", 2)
+    return backend
+
+
+def runKeys(backend):
+    prefix = storage.pathToString(PATH) + "#run"
+    return sorted(key for key in backend.items if key.startswith(prefix))
+
+
+def test_every_kept_version_replays(versioned):
+    assert storage.createFile(PATH, sheet(1))
+    for n in range(2, 8):
+        assert storage.updateFile(PATH, sheet(n))
+    listed = [v["n"] for v in storage.listVersions(PATH)]
+    # runs of 1-3 and 4-6, then 7; the first run is dropped whole
+    assert listed == [4, 5, 6, 7]
+    for n in listed:
+        assert storage.readVersion(PATH, n) == sheet(n)
+    assert storage.readVersion(PATH, 1) is None
+    # closed runs are stored apart, the dropped ones deleted
+    assert runKeys(versioned) == [storage.runKey(PATH, 4)]
+
+
+def test_restore_adds_the_old_content_as_a_new_version(versioned):
+    assert storage.createFile(PATH, sheet(1))
+    assert storage.updateFile(PATH, sheet(2))
+    assert storage.restoreVersion(PATH, 1)
+    assert storage.fetchFile(PATH) == sheet(1)
+    assert [v["n"] for v in storage.listVersions(PATH)] == [1, 2, 3]
+    assert storage.readVersion(PATH, 3) == sheet(1)
+    assert not storage.restoreVersion(PATH, 9)
+
+
+def test_deleting_the_file_deletes_its_history(versioned):
+    assert storage.createFile(PATH, sheet(1))
+    for n in range(2, 6):
+        assert storage.updateFile(PATH, sheet(n))
+    assert runKeys(versioned)
+    assert storage.deleteFile(PATH)
+    assert storage.listVersions(PATH) == []
+    assert runKeys(versioned) == []